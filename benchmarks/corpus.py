@@ -0,0 +1,63 @@
+import subprocess
+
+from pathlib import Path
+
+
+CORPUS_DURATIONS = [5, 30, 120]
+CORPUS_FORMATS = [".wav", ".mp3", ".ogg"]
+
+
+def make_corpus(
+    directory: Path,
+    durations: list[int] = CORPUS_DURATIONS,
+    formats: list[str] = CORPUS_FORMATS,
+) -> list[Path]:
+    """
+    Generates a synthetic corpus of every duration in every format with ffmpeg.
+
+    The recordings are a modulated tone with bursts of pauses over background noise,
+    so they pass the voice activity detection like speech does.
+    Files which already exist are reused, so the corpus stays the same between runs.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    corpus: list[Path] = []
+
+    for duration in durations:
+        for extension in formats:
+            audio_path = directory / f"synthetic_{duration}s{extension}"
+            corpus.append(audio_path)
+
+            if audio_path.exists():
+                continue
+
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    f"sine=frequency=220:sample_rate=44100:duration={duration}",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    f"anoisesrc=color=pink:amplitude=0.02:sample_rate=44100:duration={duration}",
+                    "-filter_complex",
+                    # Syllable-like amplitude modulation with a pause every few seconds
+                    "[0]volume='0.4*(0.6+0.4*sin(2*PI*4*t))*lt(mod(t,4),3)':eval=frame[tone];"
+                    "[tone][1]amix=inputs=2:duration=shortest",
+                    "-ac",
+                    "1",
+                    f"{audio_path.absolute().as_posix()}",
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+
+    return corpus
+
+
+def load_corpus(directory: Path, extensions: list[str] = CORPUS_FORMATS) -> list[Path]:
+    """Returns the fixture recordings found in the given directory"""
+    return sorted(path for path in directory.iterdir() if path.suffix in extensions)
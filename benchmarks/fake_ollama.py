@@ -0,0 +1,128 @@
+import json
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+from time import time as getTime
+
+
+# Prompt kinds recognised by the beginning of the prompt text of `ReviewAnalizer`
+PROMPT_KINDS = {
+    "Correct the original text": "structured",
+    "I want you to correct": "correction",
+    "I want you to translate": "translation",
+    "I want you to make a short summary": "summary",
+    "I want you to make a list of any issues": "issues",
+    "You are an expert in classifying": "department",
+}
+
+
+class FakeOllama:
+    """
+    A local stand-in for the Ollama HTTP API with a configurable latency.
+
+    Answers `/api/chat` with canned responses of the right shape for every prompt of
+    `ReviewAnalizer`, and records how long every request took, grouped by the prompt kind.
+    """
+
+    def __init__(self, latency: float, issues_count: int = 3, port: int = 0) -> None:
+        self.latency = latency
+        self.issues_count = issues_count
+        self.durations: dict[str, list[float]] = {}
+        self.__lock = Lock()
+        self.__server = ThreadingHTTPServer(("127.0.0.1", port), self.__make_handler())
+
+    @property
+    def host(self) -> str:
+        (address, port) = self.__server.server_address[:2]
+        return f"http://{address}:{port}"
+
+    def start(self) -> None:
+        Thread(target=self.__server.serve_forever, name="fake-ollama", daemon=True).start()
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+
+    def record(self, kind: str, duration: float) -> None:
+        with self.__lock:
+            self.durations.setdefault(kind, []).append(duration)
+
+    def respond(self, request: dict) -> str:
+        messages = request.get("messages") or []
+        prompt = messages[-1]["content"] if messages else ""
+        kind = self.kind_of(prompt)
+
+        # The input is echoed back, so the following prompts of a review differ between reviews
+        # and are not answered by the prompt cache
+        review = prompt.split(": ")[-1]
+
+        if kind == "structured":
+            return json.dumps(
+                {
+                    "corrected_text": review,
+                    "summary": review,
+                    "issues": [
+                        {
+                            "description": f"Issue number {index} of {review}",
+                            "department": "kitchen",
+                        }
+                        for index in range(self.issues_count)
+                    ],
+                }
+            )
+
+        if kind == "issues":
+            return (
+                "\n".join(f"Issue number {index} of {review}" for index in range(self.issues_count))
+                or "None"
+            )
+
+        if kind == "department":
+            return "Kitchen"
+
+        return review
+
+    def kind_of(self, prompt: str) -> str:
+        for prefix, kind in PROMPT_KINDS.items():
+            if prefix in prompt:
+                return kind
+
+        return "other"
+
+    def __make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                start_time = getTime()
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+
+                if self.path == "/api/chat":
+                    messages = request.get("messages") or []
+                    kind = fake.kind_of(messages[-1]["content"]) if messages else "load"
+
+                    if messages:
+                        sleep(fake.latency)
+
+                    body = {
+                        "model": request.get("model", ""),
+                        "created_at": "2025-01-01T00:00:00Z",
+                        "message": {"role": "assistant", "content": fake.respond(request)},
+                        "done": True,
+                    }
+                    fake.record(kind, getTime() - start_time)
+                else:
+                    body = {"status": "success"}
+
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
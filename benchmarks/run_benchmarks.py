@@ -0,0 +1,288 @@
+"""
+Per-stage benchmarks of the review pipeline.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --stages preprocess,archive,vad,llm --output bench.json
+    python -m benchmarks.run_benchmarks --baseline bench.json
+
+Every stage reports its p50/p95 latency, throughput and the peak RSS as JSON,
+and with `--baseline` the results are compared with a previous run.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+
+from pathlib import Path
+from time import perf_counter
+from datetime import datetime, timezone
+
+import settings
+
+from benchmarks.corpus import make_corpus, load_corpus, CORPUS_DURATIONS, CORPUS_FORMATS
+from benchmarks.fake_ollama import FakeOllama
+
+
+STAGES = ["preprocess", "archive", "vad", "whisper", "llm"]
+SAMPLE_REVIEW = (
+    "The food was cold when it arrived and we waited fourty minutes for it. "
+    "The waiter was rude, and the cocktails were too sweet. The desert was great though."
+)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(int(round(fraction * len(ordered))) - 1, 0))]
+
+
+def peak_rss_mb() -> tuple[float, float]:
+    """Peak RSS of this process and of its finished children (ffmpeg), in megabytes"""
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    )
+
+
+def summarize(stage: str, durations: list[float], audio_seconds: float | None = None) -> dict:
+    total = sum(durations)
+    (rss, children_rss) = peak_rss_mb()
+
+    return {
+        "stage": stage,
+        "runs": len(durations),
+        "p50_ms": percentile(durations, 0.50) * 1000,
+        "p95_ms": percentile(durations, 0.95) * 1000,
+        "mean_ms": total / len(durations) * 1000,
+        "throughput_per_s": len(durations) / total if total > 0 else None,
+        # How many seconds of audio are processed per second, for the audio stages
+        "audio_seconds_per_s": audio_seconds / total if audio_seconds and total > 0 else None,
+        "peak_rss_mb": rss,
+        "peak_children_rss_mb": children_rss,
+    }
+
+
+def redirect_state(workdir: Path) -> None:
+    """Keeps the caches and the durable state of the benchmark away from the real ones"""
+    settings.TRANSCRIPTION_CACHE_PATH = workdir / "transcriptions.sqlite3"
+    settings.PROMPT_CACHE_PATH = workdir / "prompts.sqlite3"
+    settings.UPLOAD_OUTBOX_PATH = workdir / "upload-outbox.sqlite3"
+    settings.JOB_JOURNAL_PATH = workdir / "jobs.sqlite3"
+    settings.DELETE_CONVERTED_FILES = False
+
+    # The metric samples too, which are written as soon as `modules.metrics` is imported,
+    # so this has to run before any of the `modules` are
+    metrics_dir = workdir / "metrics"
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    settings.METRICS_DIR = metrics_dir
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir.absolute().as_posix()
+
+
+def benchmark_audio(corpus: list[Path], stages: list[str], repeat: int) -> list[dict]:
+    from modules.ais.audio_preprocessor import AudioPreprocessor, SAMPLING_RATE
+    from modules.ais.voice_activity import VoiceActivityDetector
+
+    preprocessor = AudioPreprocessor()
+    detector = VoiceActivityDetector(SAMPLING_RATE)
+    transcriber = None
+
+    if "whisper" in stages:
+        from modules.ais.audio_transcriber import AudioTranscriber
+
+        transcriber = AudioTranscriber()
+
+    durations: dict[str, list[float]] = {stage: [] for stage in stages if stage != "llm"}
+    audio_seconds: dict[str, float] = {stage: 0.0 for stage in durations}
+    results: list[dict] = []
+
+    for audio_path in corpus:
+        file_durations: dict[str, list[float]] = {stage: [] for stage in durations}
+        samples = None
+        seconds = 0.0
+
+        for _ in range(repeat):
+            start_time = perf_counter()
+            samples = preprocessor.load_for_speech(audio_path)
+            file_durations.setdefault("preprocess", []).append(perf_counter() - start_time)
+            seconds = len(samples) / SAMPLING_RATE
+
+            if "archive" in stages:
+                start_time = perf_counter()
+                preprocessor.archive_async(audio_path, samples).result()
+                file_durations["archive"].append(perf_counter() - start_time)
+
+            start_time = perf_counter()
+            activity = detector.detect(samples)
+            vad_duration = perf_counter() - start_time
+
+            if "vad" in stages:
+                file_durations["vad"].append(vad_duration)
+
+            if transcriber is not None:
+                voiced = detector.trim(samples, activity)
+
+                start_time = perf_counter()
+                transcriber.transcribe_samples(voiced)
+                file_durations["whisper"].append(perf_counter() - start_time)
+
+        for stage, stage_durations in file_durations.items():
+            if stage not in durations or len(stage_durations) == 0:
+                continue
+
+            durations[stage] += stage_durations
+            audio_seconds[stage] += seconds * len(stage_durations)
+            results.append(
+                summarize(
+                    f"{stage}:{audio_path.name}", stage_durations, seconds * len(stage_durations)
+                )
+            )
+
+    for stage, stage_durations in durations.items():
+        if len(stage_durations) > 0:
+            results.insert(0, summarize(stage, stage_durations, audio_seconds[stage]))
+
+    return results
+
+
+def benchmark_llm(
+    repeat: int, latency: float, issues_count: int, mode: str, sequential: bool
+) -> list[dict]:
+    fake_ollama = FakeOllama(latency, issues_count)
+    fake_ollama.start()
+
+    # The ollama client reads its host when it is imported
+    os.environ["OLLAMA_HOST"] = fake_ollama.host
+    settings.STRUCTURED_ANALYSIS = mode == "structured"
+    settings.CONCURRENT_ANALYSIS = not sequential
+
+    from modules.ais.review_analizer import ReviewAnalizer
+
+    analizer = ReviewAnalizer()
+    durations: list[float] = []
+
+    for index in range(repeat):
+        # Every review is different, so the prompt cache does not answer instead of the server
+        start_time = perf_counter()
+        analizer.summarize_review(f"{SAMPLE_REVIEW} Visit #{index}.")
+        durations.append(perf_counter() - start_time)
+
+    fake_ollama.stop()
+
+    results = [summarize("llm:review", durations)]
+    for kind, kind_durations in sorted(fake_ollama.durations.items()):
+        if kind != "load":
+            results.append(summarize(f"llm:{kind}", kind_durations))
+
+    return results
+
+
+def compare(results: list[dict], baseline: dict) -> list[dict]:
+    baseline_stages = {result["stage"]: result for result in baseline.get("stages", [])}
+    comparison: list[dict] = []
+
+    for result in results:
+        previous = baseline_stages.get(result["stage"])
+        if previous is None:
+            continue
+
+        comparison.append(
+            {
+                "stage": result["stage"],
+                # Below 1.0 is faster than the baseline
+                "p50_ratio": result["p50_ms"] / previous["p50_ms"] if previous["p50_ms"] else None,
+                "p95_ratio": result["p95_ms"] / previous["p95_ms"] if previous["p95_ms"] else None,
+                "peak_rss_delta_mb": result["peak_rss_mb"] - previous["peak_rss_mb"],
+            }
+        )
+
+    return comparison
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-stage benchmarks of the review pipeline")
+    parser.add_argument(
+        "--stages", default="preprocess,archive,vad,llm", help=f"any of {','.join(STAGES)}"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every stage for every input")
+    parser.add_argument(
+        "--corpus",
+        type=Path,
+        help="directory with fixture recordings instead of the synthetic ones",
+    )
+    parser.add_argument(
+        "--durations",
+        default=",".join(map(str, CORPUS_DURATIONS)),
+        help="synthetic corpus durations, in seconds",
+    )
+    parser.add_argument(
+        "--formats", default=",".join(CORPUS_FORMATS), help="synthetic corpus formats"
+    )
+    parser.add_argument(
+        "--ollama-latency", type=float, default=0.2, help="latency of the fake Ollama, in seconds"
+    )
+    parser.add_argument(
+        "--issues", type=int, default=3, help="issues the fake Ollama finds in a review"
+    )
+    parser.add_argument("--llm-mode", choices=["structured", "chain"], default="structured")
+    parser.add_argument("--sequential", action="store_true", help="send the prompts one at a time")
+    parser.add_argument("--workdir", type=Path, help="where the corpus and the caches are kept")
+    parser.add_argument("--baseline", type=Path, help="results of a previous run to compare with")
+    parser.add_argument(
+        "--output", type=Path, help="write the results to this file instead of stdout"
+    )
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="wav-parser-bench-"))
+    redirect_state(workdir)
+
+    results: list[dict] = []
+
+    if any(stage != "llm" for stage in stages):
+        if args.corpus is not None:
+            # Copied, so the archival files are not written next to the fixtures
+            corpus = []
+            for fixture in load_corpus(args.corpus):
+                (workdir / "corpus").mkdir(parents=True, exist_ok=True)
+                corpus.append(Path(shutil.copy(fixture, workdir / "corpus" / fixture.name)))
+        else:
+            corpus = make_corpus(
+                workdir / "corpus",
+                [int(duration) for duration in args.durations.split(",")],
+                args.formats.split(","),
+            )
+
+        results += benchmark_audio(corpus, stages, args.repeat)
+
+    if "llm" in stages:
+        results += benchmark_llm(
+            args.repeat, args.ollama_latency, args.issues, args.llm_mode, args.sequential
+        )
+
+    report: dict = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "arguments": {key: str(value) for key, value in vars(args).items()},
+        "stages": results,
+    }
+
+    if args.baseline is not None:
+        report["baseline_comparison"] = compare(results, json.loads(args.baseline.read_text()))
+
+    output = json.dumps(report, indent=2)
+
+    if args.output is not None:
+        args.output.write_text(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
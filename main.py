@@ -1,33 +1,56 @@
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Queue
 
 from modules.bots.tg_bot import TelegramBot
 from modules.ftp_server import FtpServer
-from modules.log import setup_custom_logger
+from modules.log import setup_custom_logger, start_log_listener, stop_log_listener
+from modules.metrics import reset_metrics, start_metrics_server
 from modules.reviewing.review_context import ReviewQueues, ReviewContext
-from settings import LOGGER_NAME
-
-
-logger = setup_custom_logger(LOGGER_NAME)
+from modules.reviewing.bot_strategy import BotReviewStrategy
+from modules.reviewing.device_strategy import DeviceStrategy
+from modules.storage_compactor import StorageCompactor
+from settings import LOGGER_NAME, STORAGE_COMPACTION
 
 
 if __name__ == "__main__":
-    with Manager() as manager:
-        review_queues = ReviewQueues()
-        review_queues.audio_queue = manager.Queue()
-        review_queues.text_queue = manager.Queue()
-    
-        review_process = Process(target=ReviewContext(review_queues).run_reviewing, name="Reviewing")
-        review_process.start()
-
-        ftp_process = Process(target=FtpServer(review_queues).run_ftp_server, name="FTP")
-        ftp_process.start()
-
-        telegram_process = Process(
-            target=TelegramBot(review_queues).run_telegram_bot, name="Telegram bot"
+    # The other processes only send their records to the logging process, which writes them all
+    logger = setup_custom_logger(LOGGER_NAME, start_log_listener())
+
+    # Jobs and replies are small plain records, so they go through pipes directly
+    # instead of a Manager server process
+    review_queues = ReviewQueues()
+    review_queues.audio_queue = Queue()
+    review_queues.text_queue = Queue()
+    review_queues.reply_queues = {
+        DeviceStrategy.SOURCE: Queue(),
+        BotReviewStrategy.SOURCE: Queue(),
+    }
+
+    # Metrics are collected from the files every process writes, so the old ones are cleared first
+    reset_metrics()
+    start_metrics_server(review_queues)
+
+    review_process = Process(target=ReviewContext(review_queues).run_reviewing, name="Reviewing")
+    review_process.start()
+
+    ftp_process = Process(target=FtpServer(review_queues).run_ftp_server, name="FTP")
+    ftp_process.start()
+
+    telegram_process = Process(
+        target=TelegramBot(review_queues).run_telegram_bot, name="Telegram bot"
+    )
+    telegram_process.start()
+
+    if STORAGE_COMPACTION:
+        # Never waited for, it is only stopped with the others
+        compaction_process = Process(
+            target=StorageCompactor().run_compaction, name="Storage compaction", daemon=True
         )
-        telegram_process.start()
+        compaction_process.start()
 
-        # Wait for all processes to finish
+    # Wait for all processes to finish
+    try:
         ftp_process.join()
         telegram_process.join()
         review_process.join()
+    finally:
+        stop_log_listener()
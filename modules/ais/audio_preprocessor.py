@@ -0,0 +1,249 @@
+import wave
+import subprocess
+import numpy as np
+
+from io import BytesIO
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from logging import getLogger
+from traceback import format_exc
+from typing import NamedTuple
+
+from modules.metrics import STAGE_DURATION, ERRORS
+from settings import DELETE_CONVERTED_FILES, LOGGER_NAME
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+# Whisper models expect 16 kHz mono audio
+SAMPLING_RATE = 16_000
+SPEECH_FILTERS = "volume=1.7, arnndn=m=mp.rnnn"
+
+
+def archive_path_for(audio_path: Path) -> Path:
+    """Returns the path of the archival .ogg file made for the given recording"""
+    return audio_path.with_name(f"{audio_path.stem}_speech.ogg")
+
+
+class BufferedAudio(NamedTuple):
+    """A recording received into memory, `path` is where its raw file is persisted"""
+
+    path: Path
+    data: bytes
+
+
+def path_of(audio: Path | BufferedAudio) -> Path:
+    return audio.path if isinstance(audio, BufferedAudio) else audio
+
+
+def audio_duration(audio: Path | BufferedAudio) -> float | None:
+    """
+    Reads the duration (in seconds) of the recording from its header, without decoding it.
+    Returns `None` if the duration is unknown
+    """
+    data = audio.data if isinstance(audio, BufferedAudio) else None
+
+    if path_of(audio).suffix == ".wav":
+        try:
+            with wave.open(
+                BytesIO(data) if data is not None else path_of(audio).as_posix(), "rb"
+            ) as wav_file:
+                return wav_file.getnframes() / wav_file.getframerate()
+        except (wave.Error, EOFError):
+            # Not a plain PCM .wav file, ffprobe knows the other formats
+            pass
+
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "csv=p=0",
+                "pipe:0" if data is not None else path_of(audio).absolute().as_posix(),
+            ],
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            timeout=10,
+        )
+        return float(result.stdout.decode().strip())
+    except (subprocess.SubprocessError, OSError, ValueError):
+        return None
+
+
+def persist_recording(audio_path: Path, data: bytes, check_archive: bool = True) -> bool:
+    """
+    Writes a recording received into memory to its file.
+    Returns `False` if the file could not be written
+    """
+    # The archival copy is already there, and the original would be deleted right after it was made
+    if check_archive and DELETE_CONVERTED_FILES and archive_path_for(audio_path).exists():
+        return True
+
+    try:
+        # Written under a temporary name, so a half-written file is never taken for the recording
+        part_path = audio_path.with_name(f"{audio_path.name}.part")
+        part_path.write_bytes(data)
+        part_path.replace(audio_path)
+    except Exception as ex:
+        logger.error(
+            f"Exception catched durint recording persisting: {ex} {ex.args}\n{format_exc()}"
+        )
+        return False
+
+    return True
+
+
+class AudioPreprocessor:
+    """
+    Prepares recordings for the speech recognition model.
+
+    The recording is decoded once, the gain and denoise filters are applied in the same
+    ffmpeg run, and the resulting 16 kHz PCM is streamed through a pipe straight into memory.
+    The archival .ogg file is encoded from those samples in a background thread.
+    """
+
+    def __init__(self) -> None:
+        self.__archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ogg-archiver")
+
+    def load_for_speech(self, audio: Path | BufferedAudio) -> np.ndarray:
+        """
+        Decodes the given audio file, or the recording in memory,
+        into normalized and denoised 16 kHz mono samples.
+
+        Falls back to decoding without filters if the filtering fails.
+        """
+        logger.debug("Decoding %s for speech...", path_of(audio))
+
+        try:
+            samples = self.__decode(audio, SPEECH_FILTERS)
+            logger.info("Audio decoded and normalized for speech.")
+            return samples
+        except subprocess.CalledProcessError as ex:
+            ERRORS.labels("ffmpeg_decode").inc()
+            logger.error(f"Command failed with exit code: {ex.returncode}:\n{ex.stderr.decode()}")
+
+        logger.warning("Decoding the audio file without speech filters...")
+        return self.__decode(audio, None)
+
+    def archive_async(self, audio_path: Path, samples: np.ndarray) -> Future[Path | None]:
+        """Encodes the prepared samples into an archival .ogg file without blocking the caller"""
+        return self.__archiver.submit(self.__archive, audio_path, samples)
+
+    def archive_recording_async(self, audio: Path | BufferedAudio) -> Future[Path | None]:
+        """
+        Decodes the recording and encodes it into an archival .ogg file without blocking the caller,
+        for the recordings whose samples are not needed otherwise, e.g. with a cached transcription
+        """
+        return self.__archiver.submit(self.__decode_and_archive, audio)
+
+    def __decode_and_archive(self, audio: Path | BufferedAudio) -> Path | None:
+        try:
+            samples = self.load_for_speech(audio)
+        except Exception as ex:
+            ERRORS.labels("ffmpeg_archive").inc()
+            logger.error(
+                f"Exception catched durint audio archiving: {ex} {ex.args}\n{format_exc()}"
+            )
+            return None
+
+        return self.__archive(path_of(audio), samples)
+
+    def __decode(self, audio: Path | BufferedAudio, filters: str | None) -> np.ndarray:
+        if isinstance(audio, BufferedAudio):
+            # The recording is fed through stdin, it never has to be read back from the disk
+            command = ["ffmpeg", "-i", "pipe:0"]
+        else:
+            command = ["ffmpeg", "-nostdin", "-i", f"{audio.absolute().as_posix()}"]
+
+        if filters is not None:
+            command += ["-af", filters]
+
+        command += [
+            "-ac",
+            "1",
+            "-ar",
+            str(SAMPLING_RATE),
+            "-acodec",
+            "pcm_s16le",
+            "-f",
+            "s16le",
+            "pipe:1",
+        ]
+
+        with STAGE_DURATION.labels("ffmpeg_decode").time():
+            result = subprocess.run(
+                command,
+                input=audio.data if isinstance(audio, BufferedAudio) else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+
+        return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+    def __archive(self, audio_path: Path, samples: np.ndarray) -> Path | None:
+        output_path = archive_path_for(audio_path)
+        # Encoded under a temporary name, so a file ffmpeg has not finished is never taken
+        # for the archival copy by the uploads and the storage compaction
+        part_path = output_path.with_name(f"{output_path.name}.part")
+        logger.debug("Archiving %s into %s...", audio_path, output_path)
+
+        try:
+            pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+
+            with STAGE_DURATION.labels("ffmpeg_archive").time():
+                subprocess.run(
+                    [
+                        "ffmpeg",
+                        "-y",
+                        "-f",
+                        "s16le",
+                        "-ar",
+                        str(SAMPLING_RATE),
+                        "-ac",
+                        "1",
+                        "-i",
+                        "pipe:0",
+                        "-c:a",
+                        "libopus",
+                        "-b:a",
+                        "64k",
+                        "-f",
+                        "ogg",
+                        f"{part_path.absolute().as_posix()}",
+                    ],
+                    input=pcm,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    check=True,
+                )
+
+            part_path.replace(output_path)
+        except subprocess.CalledProcessError as ex:
+            ERRORS.labels("ffmpeg_archive").inc()
+            logger.error(f"Command failed with exit code: {ex.returncode}:\n{ex.stderr.decode()}")
+            part_path.unlink(missing_ok=True)
+            return None
+        except Exception as ex:
+            ERRORS.labels("ffmpeg_archive").inc()
+            logger.error(
+                f"Exception catched durint audio archiving: {ex} {ex.args}\n{format_exc()}"
+            )
+            part_path.unlink(missing_ok=True)
+            return None
+
+        logger.info("Audio file archived to %s", output_path)
+
+        if DELETE_CONVERTED_FILES:
+            # if the file was successfuly archived, no need to store the original
+            audio_path.unlink(missing_ok=True)
+
+        return output_path
@@ -1,14 +1,46 @@
-import subprocess
+import json
 import torch
+import numpy as np
 
+from collections import Counter
+from hashlib import sha256
 from traceback import format_exc
 from pathlib import Path
 from logging import getLogger
 from time import time as getTime
+from typing import Iterator
 from transformers import pipeline
 
+import settings
+
+from modules.disk_cache import DiskCache
+from modules.log import LogPayload
+from modules.metrics import STAGE_DURATION, ERRORS
 from modules.singleton_meta import SingletonMeta
-from settings import DELETE_CONVERTED_FILES, LOGGER_NAME
+from modules.ais.audio_preprocessor import (
+    AudioPreprocessor,
+    BufferedAudio,
+    SAMPLING_RATE,
+    archive_path_for,
+    path_of,
+)
+from modules.ais.voice_activity import VoiceActivityDetector
+from settings import (
+    LOGGER_NAME,
+    TRANSCRIPTION_BATCH_SIZE,
+    TRANSCRIPTION_CACHE_PATH,
+    TRANSCRIPTION_CACHE_MAX_ENTRIES,
+    VAD_ENABLED,
+    VAD_MIN_SPEECH_SECONDS,
+    VAD_MIN_SPEECH_RATIO,
+    STREAMING_CHUNK_SECONDS,
+    TRANSCRIBER_CPU_MODE,
+    TORCH_INTRA_OP_THREADS,
+    TORCH_INTER_OP_THREADS,
+    TRANSCRIBER_WARM_UP,
+    TRANSCRIBER_WARM_UP_SECONDS,
+    WHISPER_TRANSLATION,
+)
 
 
 logger = getLogger(LOGGER_NAME)
@@ -19,6 +51,8 @@ FAST_WHISPER_ARGS = {
     # "task": "translate",
     "max_new_tokens": 384,
 }
+# Whisper reports the detected language either by its code or by its name
+ENGLISH = ("en", "english")
 
 
 class AudioTranscriber(metaclass=SingletonMeta):
@@ -30,147 +64,540 @@ class AudioTranscriber(metaclass=SingletonMeta):
         attn_impl = "spda"
         # model="openai/whisper-base",  # select checkpoint from https://huggingface.co/openai/whisper-large-v3#model-details,
         model = "openai/whisper-large-v3-turbo"
+        mode = device if device == "cuda" else TRANSCRIBER_CPU_MODE
+
+        self.__preprocessor = AudioPreprocessor()
+        self.__voice_detector = VoiceActivityDetector(SAMPLING_RATE)
+        self.__cache = DiskCache(
+            "transcription", TRANSCRIPTION_CACHE_PATH, TRANSCRIPTION_CACHE_MAX_ENTRIES
+        )
+        # The language is detected by the model when the speech is translated
+        self.__generate_kwargs = (
+            {key: value for key, value in FAST_WHISPER_ARGS.items() if key != "language"}
+            if WHISPER_TRANSLATION
+            else FAST_WHISPER_ARGS
+        )
+        # Cached transcriptions are only valid for the same model, mode and generation arguments,
+        # and the same voice activity detection, which decides what the model hears, if anything
+        vad_settings = {
+            name: value for name, value in vars(settings).items() if name.startswith("VAD_")
+        }
+        self.__cache_salt = (
+            f"{model}|{mode}|{json.dumps(self.__generate_kwargs, sort_keys=True)}"
+            f"|translation={WHISPER_TRANSLATION}|{json.dumps(vad_settings, sort_keys=True)}"
+            # The entries were the bare text before they held the original text and its language
+            "|entry=json"
+        )
+
+        if device == "cpu":
+            self.__setup_cpu_threads()
+
+        self.__pipe = self.__build_pipeline(model, mode, torch_dtype, device_int)
+
+        real_time_factor = self.__warm_up() if TRANSCRIBER_WARM_UP else None
+
+        logger.info(
+            "Running on %s with id #%d in %s mode, using attn_implementation: %s, "
+            "real-time factor: %s",
+            device,
+            device_int,
+            mode,
+            attn_impl,
+            real_time_factor if real_time_factor is None else round(real_time_factor, 3),
+        )
+
+    def __build_pipeline(self, model: str, mode: str, torch_dtype: torch.dtype, device_int: int):
+        pipeline_kwargs = {
+            "chunk_length_s": 30,
+            "batch_size": 1,
+            "return_timestamps": True,
+            "generate_kwargs": self.__generate_kwargs,
+        }
+
+        if mode == "int8":
+            from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
+
+            # Linear layers hold most of the weights, quantizing them gives most of the speedup
+            model_instance = torch.quantization.quantize_dynamic(
+                AutoModelForSpeechSeq2Seq.from_pretrained(
+                    model, torch_dtype=torch.float32, attn_implementation="sdpa"
+                ),
+                {torch.nn.Linear},
+                dtype=torch.qint8,
+            )
+            processor = AutoProcessor.from_pretrained(model)
+
+            return pipeline(
+                "automatic-speech-recognition",
+                model=model_instance,
+                tokenizer=processor.tokenizer,
+                feature_extractor=processor.feature_extractor,
+                device=device_int,
+                **pipeline_kwargs,
+            )
 
-        self.__pipe = pipeline(
+        if mode == "onnx":
+            # Requires `pip install optimum[onnxruntime]`
+            from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+            from transformers import AutoProcessor
+
+            processor = AutoProcessor.from_pretrained(model)
+
+            return pipeline(
+                "automatic-speech-recognition",
+                model=ORTModelForSpeechSeq2Seq.from_pretrained(model, export=True),
+                tokenizer=processor.tokenizer,
+                feature_extractor=processor.feature_extractor,
+                **pipeline_kwargs,
+            )
+
+        return pipeline(
             "automatic-speech-recognition",
             model=model,
             torch_dtype=torch_dtype,
-            chunk_length_s=30,
-            batch_size=1,
-            return_timestamps=True,
             # attn_impl="sdpa",
             model_kwargs={"attn_implementation": "sdpa"},
             device=device_int,
-            generate_kwargs=FAST_WHISPER_ARGS,
+            **pipeline_kwargs,
         )
 
+    def __setup_cpu_threads(self) -> None:
+        # Inter-op threads can only be set before torch runs any parallel work
+        if TORCH_INTER_OP_THREADS is not None:
+            torch.set_num_interop_threads(TORCH_INTER_OP_THREADS)
+
+        if TORCH_INTRA_OP_THREADS is not None:
+            torch.set_num_threads(TORCH_INTRA_OP_THREADS)
+
         logger.info(
-            f"Running on {device} with id #{device_int}, using attn_implementation: {attn_impl}"
+            "Torch uses %d intra-op and %d inter-op threads",
+            torch.get_num_threads(),
+            torch.get_num_interop_threads(),
         )
 
-    def transcribe_audio(self, audio_path: Path) -> str | None:
-        try:
-            logger.info(f'Transcribing "{audio_path.as_posix()}" audio file...')
+    def __warm_up(self) -> float:
+        """
+        Runs the model once, so the first real recording does not pay for the lazy initialization.
 
-            # Normalize for speech
-            audio_path = self.__try_normalize_for_speech(audio_path)
+        Returns the measured real-time factor: the processing time divided by the audio length
+        """
+        samples = np.zeros(int(TRANSCRIBER_WARM_UP_SECONDS * SAMPLING_RATE), dtype=np.float32)
 
-            # Convert to .ogg if it's not already
-            if audio_path.suffix != ".ogg":
-                logger.info("Audio file is not in .ogg format. Tying to convert it to .ogg...")
-                audio_path = self.__try_convert_to_ogg(audio_path)
+        start_time = getTime()
+        self.__pipe(self.__pipe_input(samples))
 
-            # Transcribe audio file into text
-            start_time = getTime()
-            outputs = self.__pipe(audio_path.as_posix())
-            end_time = getTime()
+        return (getTime() - start_time) / TRANSCRIBER_WARM_UP_SECONDS
 
-            transcribed_text = str(outputs["text"])
+    def transcribe_audio(self, audio: Path | BufferedAudio) -> str | None:
+        try:
+            logger.info('Transcribing "%s" audio file...', path_of(audio).as_posix())
 
-            logger.info(
-                f"Audio '{audio_path.as_posix()}' transcribed in {end_time - start_time} seconds."
+            cache_key = self.__cache_key(audio)
+            cached = self.__get_cached(audio, cache_key)
+            if cached is not None:
+                return cached
+        except Exception as ex:
+            ERRORS.labels("whisper").inc()
+            logger.error(
+                f"Exception catched durint audio transcription: {ex} {ex.args}\n{format_exc()}"
             )
-            logger.info(f"Transcribed audio:\n{transcribed_text}")
+            return None
 
-            # Save transcribed text into a .txt file
-            Path(audio_path.with_suffix(".txt")).write_bytes(transcribed_text.encode("utf-8"))
+        return self.__transcribe_uncached(audio, cache_key)
 
-            return transcribed_text
+    def __transcribe_uncached(
+        self, audio: Path | BufferedAudio, cache_key: str | None
+    ) -> str | None:
+        """Transcribes a recording which has been looked up in the cache already"""
+        try:
+            samples = self.__prepare_audio(audio)
+
+            # Recordings without speech are not worth running the model on
+            if samples is None:
+                self.__cache_put(cache_key, {"text": ""})
+                return ""
+
+            return self.__transcribe_prepared(path_of(audio), samples, cache_key)
 
         except Exception as ex:
+            ERRORS.labels("whisper").inc()
             logger.error(
                 f"Exception catched durint audio transcription: {ex} {ex.args}\n{format_exc()}"
             )
             return None
 
-    def __try_normalize_for_speech(self, input_audio: Path) -> Path:
+    def transcribe_samples(self, samples: np.ndarray) -> str:
+        """
+        Runs the model on already prepared 16 kHz samples,
+        without the cache and without saving the result
+        """
+        return str(self.__recognize([samples])[0]["text"])
+
+    def transcribe_stream(self, audio: Path | BufferedAudio) -> Iterator[str]:
         """
-        Tries to normalize volume for speech in the given audio file.
+        Transcribes the audio file chunk by chunk, yielding the text of every chunk
+        as soon as it is ready. Yields nothing if the recording does not contain speech.
 
-        Returns the path to the converted file in case of success or
-        the path to the original file in case of errors
+        Unlike `transcribe_audio()`, errors are raised to the caller.
         """
+        audio_path = path_of(audio)
+        logger.info('Transcribing "%s" audio file in chunks...', audio_path.as_posix())
+
+        cache_key = self.__cache_key(audio)
+        cached = self.__get_cached(audio, cache_key)
+        if cached is not None:
+            if cached != "":
+                yield cached
+            return
+
+        start_time = getTime()
+        samples = self.__prepare_audio(audio)
+
+        if samples is None:
+            self.__cache_put(cache_key, {"text": ""})
+            return
+
+        chunk_length = int(STREAMING_CHUNK_SECONDS * SAMPLING_RATE)
+        texts: list[str] = []
+        originals: list[str] = []
+        languages: list[str] = []
+
+        for chunk_start in range(0, len(samples), chunk_length):
+            with STAGE_DURATION.labels("whisper").time():
+                outputs = self.__recognize([samples[chunk_start : chunk_start + chunk_length]])[0]
+            texts.append(str(outputs["text"]))
+            originals.append(str(outputs.get("original", outputs["text"])))
+            if outputs.get("language") is not None:
+                languages.append(outputs["language"])
+
+            if len(texts) == 1:
+                logger.info(
+                    "First text of '%s' transcribed in %s seconds.",
+                    audio_path.as_posix(),
+                    getTime() - start_time,
+                )
+
+            yield texts[-1]
+
+        logger.info(
+            "Audio '%s' transcribed in %s seconds in %d chunks.",
+            audio_path.as_posix(),
+            getTime() - start_time,
+            len(texts),
+        )
+
+        self.__save_transcription(
+            audio_path,
+            {
+                "text": "".join(texts),
+                "original": "".join(originals),
+                "language": Counter(languages).most_common(1)[0][0] if len(languages) > 0 else None,
+            },
+            cache_key,
+        )
+
+    def transcribe_batch(
+        self, audios: list[Path | BufferedAudio], batch_size: int = TRANSCRIPTION_BATCH_SIZE
+    ) -> list[str | None]:
+        """
+        Transcribes several audio files, or recordings in memory, in one pass through the model.
+
+        Returns the transcriptions in the same order as `audios`,
+        with `None` in place of the files which could not be transcribed,
+        and an empty string for the files without speech.
+        """
+        results: list[str | None] = [None] * len(audios)
+        cache_keys: list[str | None] = [None] * len(audios)
+
+        # Only the recordings which have not been transcribed before go through the model
+        for index, audio in enumerate(audios):
+            try:
+                cache_keys[index] = self.__cache_key(audio)
+                results[index] = self.__get_cached(audio, cache_keys[index])
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched durint cache lookup: {ex} {ex.args}\n{format_exc()}"
+                )
+
+        pending = [index for index, result in enumerate(results) if result is None]
+
+        if len(pending) == 1:
+            # Looked up already, so the recording is not read and hashed again
+            results[pending[0]] = self.__transcribe_uncached(
+                audios[pending[0]], cache_keys[pending[0]]
+            )
+        elif len(pending) > 1:
+            transcriptions = self.__transcribe_batch(
+                [audios[index] for index in pending],
+                [cache_keys[index] for index in pending],
+                batch_size,
+            )
+
+            for index, transcribed_text in zip(pending, transcriptions):
+                results[index] = transcribed_text
+
+        return results
+
+    def __transcribe_batch(
+        self, audios: list[Path | BufferedAudio], cache_keys: list[str | None], batch_size: int
+    ) -> list[str | None]:
+        logger.info("Transcribing a batch of %d audio files...", len(audios))
+        audio_paths = [path_of(audio) for audio in audios]
+
+        prepared_samples: list[np.ndarray | None] = []
+        results: list[str | None] = []
+
+        # Prepared one at a time, so a file which can not be decoded only fails itself
+        for audio, cache_key in zip(audios, cache_keys):
+            try:
+                samples = self.__prepare_audio(audio)
+            except Exception as ex:
+                ERRORS.labels("whisper").inc()
+                logger.error(
+                    f"Exception catched durint audio preparation: {ex} {ex.args}\n{format_exc()}"
+                )
+                prepared_samples.append(None)
+                results.append(None)
+                continue
+
+            prepared_samples.append(samples)
+
+            # Recordings without speech are not worth running the model on
+            if samples is None:
+                self.__cache_put(cache_key, {"text": ""})
+                results.append("")
+            else:
+                results.append(None)
 
-        logger.debug("Normalizing volume for speech...")
+        voiced = [index for index, samples in enumerate(prepared_samples) if samples is not None]
+
+        if len(voiced) == 0:
+            return results
 
         try:
-            # New file will have the same name
-            output_path = input_audio
+            start_time = getTime()
+            outputs = self.__recognize([prepared_samples[index] for index in voiced], batch_size)
+            end_time = getTime()
+
+            # Observed per recording, so batched and single transcriptions are comparable
+            for _ in voiced:
+                STAGE_DURATION.labels("whisper").observe((end_time - start_time) / len(voiced))
 
-            # Original file will have a different name
-            input_audio = input_audio.rename(
-                input_audio.absolute().with_stem(f"{input_audio.stem}_original")
+            logger.info(
+                "Batch of %d audio files transcribed in %s seconds.",
+                len(voiced),
+                end_time - start_time,
             )
 
-            subprocess.run(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    f"{input_audio.absolute().as_posix()}",
-                    "-af",
-                    "volume=1.7, arnndn=m=mp.rnnn",
-                    "-acodec",
-                    "pcm_s16le",
-                    "-f",
-                    "wav",
-                    f"{output_path.absolute().as_posix()}",
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True,
+            for index, output in zip(voiced, outputs):
+                results[index] = self.__save_transcription(
+                    audio_paths[index], output, cache_keys[index]
+                )
+
+            return results
+
+        except Exception as ex:
+            ERRORS.labels("whisper").inc()
+            logger.error(
+                f"Exception catched durint batch transcription: {ex} {ex.args}\n{format_exc()}"
             )
-        except subprocess.CalledProcessError as ex:
-            logger.error(f"Command failed with exit code: {ex.returncode}:\n{ex.stderr}")
-            return input_audio
 
-        logger.info("Audio volume normalized for speech.")
+        # Some file has broken the whole batch, so transcribe them one by one
+        # to get as many transcriptions as possible
+        logger.warning("Falling back to transcribing the batch one file at a time...")
+
+        for index in voiced:
+            try:
+                results[index] = self.__transcribe_prepared(
+                    audio_paths[index], prepared_samples[index], cache_keys[index]
+                )
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched durint audio transcription: {ex} {ex.args}\n{format_exc()}"
+                )
+
+        return results
+
+    def __cache_key(self, audio: Path | BufferedAudio) -> str:
+        digest = sha256(self.__cache_salt.encode("utf-8"))
+
+        if isinstance(audio, BufferedAudio):
+            digest.update(audio.data)
+            return digest.hexdigest()
+
+        with open(audio, "rb") as audio_file:
+            while chunk := audio_file.read(1 << 20):
+                digest.update(chunk)
 
-        if DELETE_CONVERTED_FILES:
-            # if the wav file was successfuly converted, no need to store it
-            Path(input_audio).unlink()
+        return digest.hexdigest()
 
-        return output_path
+    def __get_cached(self, audio: Path | BufferedAudio, cache_key: str) -> str | None:
+        entry = self.__cache.get(cache_key)
 
-    def __try_convert_to_ogg(self, input_audio: Path) -> Path:
+        if entry is None:
+            return None
+
+        audio_path = path_of(audio)
+        logger.info(
+            "Audio '%s' has already been transcribed. Using the cached text.", audio_path.as_posix()
+        )
+
+        # The same recording uploaded again under another name still needs its archival copy
+        if not archive_path_for(audio_path).exists():
+            self.__preprocessor.archive_recording_async(audio)
+
+        return self.__write_transcription(audio_path, json.loads(entry))
+
+    def __cache_put(self, cache_key: str | None, outputs: dict) -> None:
+        """Caches the text with the original and its language, so a hit writes the same files"""
+        if cache_key is None:
+            return
+
+        entry = {
+            "text": str(outputs["text"]),
+            "original": None if outputs.get("original") is None else str(outputs["original"]),
+            "language": outputs.get("language"),
+        }
+        self.__cache.put(cache_key, json.dumps(entry, ensure_ascii=False))
+
+    def __transcribe_prepared(
+        self, audio_path: Path, samples: np.ndarray, cache_key: str | None
+    ) -> str:
+        # Transcribe audio samples into text
+        start_time = getTime()
+        outputs = self.__recognize([samples])[0]
+        end_time = getTime()
+        STAGE_DURATION.labels("whisper").observe(end_time - start_time)
+
+        logger.info(
+            "Audio '%s' transcribed in %s seconds.", audio_path.as_posix(), end_time - start_time
+        )
+
+        return self.__save_transcription(audio_path, outputs, cache_key)
+
+    def __prepare_audio(self, audio: Path | BufferedAudio) -> np.ndarray | None:
         """
-        Tries to convert a .wav file to an .ogg one and normalize the volume.
+        Decodes the audio file into samples ready for the model,
+        and archives them into an .ogg file in the background.
 
-        Returns the path to the converted file in case of success or
-        the path to the original file in case of errors
+        Returns `None` if the recording does not contain speech
         """
-        logger.debug(f"Converting {input_audio} to .ogg...")
+        audio_path = path_of(audio)
+        samples = self.__preprocessor.load_for_speech(audio)
+        self.__preprocessor.archive_async(audio_path, samples)
 
-        try:
-            # New file will have same name but different extension
-            output_path = input_audio.with_suffix(".ogg")
-
-            subprocess.run(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    f"{input_audio.absolute().as_posix()}",
-                    "-c:a",
-                    "libopus",
-                    "-b:a",
-                    "64k",
-                    f"{output_path.absolute().as_posix()}",
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True,
+        if not VAD_ENABLED:
+            return samples
+
+        activity = self.__voice_detector.detect(samples)
+
+        logger.info(
+            "Audio '%s' contains %.1f seconds of speech (%.0f%%) in %d regions.",
+            audio_path.as_posix(),
+            activity.speech_seconds,
+            activity.speech_ratio * 100,
+            len(activity.regions),
+        )
+
+        if (
+            activity.speech_seconds < VAD_MIN_SPEECH_SECONDS
+            or activity.speech_ratio < VAD_MIN_SPEECH_RATIO
+        ):
+            logger.info("Audio '%s' does not contain speech. Skipping it.", audio_path.as_posix())
+            return None
+
+        # Only the voiced parts are sent to the model
+        return self.__voice_detector.trim(samples, activity)
+
+    def __recognize(self, samples: list[np.ndarray], batch_size: int = 1) -> list[dict]:
+        """
+        Runs the model on the samples of several recordings, returning an output for every one.
+
+        With `WHISPER_TRANSLATION`, the language of every recording is detected, and the ones
+        which are not in English are run again with the translate task: their "text" is then
+        the English translation, "original" the text as it was spoken,
+        and "language" the detected language.
+        """
+        if not WHISPER_TRANSLATION:
+            return list(
+                self.__pipe([self.__pipe_input(chunk) for chunk in samples], batch_size=batch_size)
+            )
+
+        outputs = list(
+            self.__pipe(
+                [self.__pipe_input(chunk) for chunk in samples],
+                batch_size=batch_size,
+                return_language=True,
             )
-        except subprocess.CalledProcessError as ex:
-            logger.error(f"Command failed with exit code: {ex.returncode}:\n{ex.stderr}")
-            return input_audio
+        )
+
+        # Recordings of the same language are translated together
+        foreign: dict[str, list[int]] = {}
+
+        for index, output in enumerate(outputs):
+            output["original"] = output["text"]
+            output["language"] = self.__spoken_language(output)
+
+            if output["language"] is not None and output["language"] not in ENGLISH:
+                foreign.setdefault(output["language"], []).append(index)
+
+        for language, indexes in foreign.items():
+            translations = self.__pipe(
+                [self.__pipe_input(samples[index]) for index in indexes],
+                batch_size=batch_size,
+                generate_kwargs={
+                    **self.__generate_kwargs,
+                    "task": "translate",
+                    "language": language,
+                },
+            )
+
+            for index, translation in zip(indexes, translations):
+                outputs[index]["text"] = translation["text"]
 
-        logger.info("Audio file converted to .ogg")
+        return outputs
 
-        if DELETE_CONVERTED_FILES:
-            # if the wav file was successfuly converted, no need to store it
-            Path(input_audio).unlink()
+    def __spoken_language(self, outputs: dict) -> str | None:
+        """The language most of the recording is in, `None` if the model did not report it"""
+        languages = [
+            str(chunk["language"]).lower()
+            for chunk in outputs.get("chunks", [])
+            if chunk.get("language") is not None
+        ]
+
+        if len(languages) == 0:
+            return None
+
+        return Counter(languages).most_common(1)[0][0]
+
+    def __pipe_input(self, samples: np.ndarray) -> dict:
+        # The pipeline consumes the dict it is given, so a new one is made for every call
+        return {"raw": samples, "sampling_rate": SAMPLING_RATE}
+
+    def __save_transcription(self, audio_path: Path, outputs: dict, cache_key: str | None) -> str:
+        logger.info("Transcribed audio:\n%s", LogPayload(outputs["text"]))
+
+        transcribed_text = self.__write_transcription(audio_path, outputs)
+        self.__cache_put(cache_key, outputs)
+
+        return transcribed_text
+
+    def __write_transcription(self, audio_path: Path, outputs: dict) -> str:
+        transcribed_text = str(outputs["text"])
+
+        # Save transcribed text into a .txt file
+        Path(audio_path.with_suffix(".txt")).write_bytes(transcribed_text.encode("utf-8"))
+
+        # The text as it was spoken is kept next to its English translation
+        original_text = outputs.get("original")
+        if original_text is not None and str(original_text) != transcribed_text:
+            logger.info(
+                "Translated from %s, original text:\n%s",
+                outputs.get("language"),
+                LogPayload(original_text),
+            )
+            Path(audio_path.with_suffix(".original.txt")).write_bytes(
+                str(original_text).encode("utf-8")
+            )
 
-        return output_path
+        return transcribed_text
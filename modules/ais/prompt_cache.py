@@ -0,0 +1,105 @@
+import json
+
+from collections import OrderedDict
+from hashlib import sha256
+from logging import getLogger
+from threading import Lock
+from time import time as getTime
+
+from modules.disk_cache import DiskCache
+from modules.metrics import CACHE_LOOKUPS
+from settings import (
+    LOGGER_NAME,
+    PROMPT_CACHE_PATH,
+    PROMPT_CACHE_MEMORY_ENTRIES,
+    PROMPT_CACHE_MAX_ENTRIES,
+    PROMPT_CACHE_TTL,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class PromptCache:
+    """
+    Two-tier cache of LLM responses keyed on the model name and the exact prompt.
+
+    Recently used responses are kept in an in-process LRU, backed by a `DiskCache`
+    which survives restarts. Both tiers forget responses older than `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        memory_entries: int = PROMPT_CACHE_MEMORY_ENTRIES,
+        disk_entries: int = PROMPT_CACHE_MAX_ENTRIES,
+        ttl: float = PROMPT_CACHE_TTL,
+    ) -> None:
+        self.__memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.__memory_entries = memory_entries
+        self.__ttl = ttl
+        self.__lock = Lock()
+        self.__disk = DiskCache("prompt_disk", PROMPT_CACHE_PATH, disk_entries, ttl)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, model: str, prompt: str, response_format: dict | None = None) -> str | None:
+        key = self.__key(model, prompt, response_format)
+
+        with self.__lock:
+            entry = self.__memory.get(key)
+
+            if entry is not None and getTime() - entry[1] <= self.__ttl:
+                self.__memory.move_to_end(key)
+                self.memory_hits += 1
+                CACHE_LOOKUPS.labels("prompt_memory", "hit").inc()
+                return entry[0]
+
+            if entry is not None:
+                del self.__memory[key]
+
+            CACHE_LOOKUPS.labels("prompt_memory", "miss").inc()
+
+        entry = self.__disk.get_entry(key)
+
+        with self.__lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            # Keeps the time of the disk entry, so promoting it does not extend its life
+            self.__remember(key, *entry)
+
+        return entry[0]
+
+    def put(
+        self, model: str, prompt: str, response: str, response_format: dict | None = None
+    ) -> None:
+        key = self.__key(model, prompt, response_format)
+
+        with self.__lock:
+            self.__remember(key, response, getTime())
+
+        self.__disk.put(key, response)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def __remember(self, key: str, response: str, created_at: float) -> None:
+        self.__memory[key] = (response, created_at)
+        self.__memory.move_to_end(key)
+
+        while len(self.__memory) > self.__memory_entries:
+            self.__memory.popitem(last=False)
+
+    def __key(self, model: str, prompt: str, response_format: dict | None) -> str:
+        # The exact prompt, as the model may answer differently to another letter case or spacing
+        response_format_str = json.dumps(response_format, sort_keys=True)
+
+        return sha256(f"{model}|{response_format_str}|{prompt}".encode("utf-8")).hexdigest()
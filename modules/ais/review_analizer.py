@@ -1,16 +1,47 @@
+import json
+import asyncio
+
 from logging import getLogger
+from threading import Thread
 from traceback import format_exc
 
 import ollama
 
+from modules.log import LogPayload, sample_payload
 from modules.singleton_meta import SingletonMeta
+from modules.ais.prompt_cache import PromptCache
+from modules.metrics import STAGE_DURATION
 from modules.models.issue import Issue, IssueDepartment
-from settings import LOGGER_NAME
+from settings import LOGGER_NAME, STRUCTURED_ANALYSIS, CONCURRENT_ANALYSIS, OLLAMA_MAX_CONCURRENCY
 
 
 logger = getLogger(LOGGER_NAME)
 MODEL = "llama3.2:3b"
 
+# The response format of the single-prompt analysis
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "corrected_text": {"type": "string"},
+        "summary": {"type": "string"},
+        "issues": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string"},
+                    "department": {
+                        "type": "string",
+                        "enum": [department.value for department in IssueDepartment],
+                    },
+                },
+                "required": ["description", "department"],
+            },
+        },
+    },
+    "required": ["corrected_text", "summary", "issues"],
+}
+
 
 class AnalizerResult:
     def __init__(self, corrected_text: str, summary: str, issues: list[Issue]) -> None:
@@ -22,12 +53,41 @@ class AnalizerResult:
 class ReviewAnalizer(metaclass=SingletonMeta):
     def __init__(self, model_name=MODEL) -> None:
         self.__ensure_existence(model_name)
+        self.__prompt_cache = PromptCache()
+
+        if CONCURRENT_ANALYSIS:
+            # Every caller shares one event loop, so the concurrency limit is applied to all of them
+            self.__event_loop = asyncio.new_event_loop()
+            self.__async_client = ollama.AsyncClient()
+            self.__prompt_slots = asyncio.Semaphore(OLLAMA_MAX_CONCURRENCY)
+
+            Thread(target=self.__event_loop.run_forever, name="ollama-loop", daemon=True).start()
+
+    def summarize_review(self, text: str, english: bool = False) -> AnalizerResult | None:
+        """
+        Corrects, translates and analyses the review.
+        The translation is skipped if the text is known to be in `english` already.
+        """
+        if CONCURRENT_ANALYSIS:
+            return asyncio.run_coroutine_threadsafe(
+                self.summarize_review_async(text, english), self.__event_loop
+            ).result()
 
-    def summarize_review(self, text: str) -> AnalizerResult | None:
         try:
-            corrected_text = self.__get_corrected_translated(
-                text.replace("\n", " ").replace("  ", " ")
-            )
+            text = text.replace("\n", " ").replace("  ", " ")
+
+            if STRUCTURED_ANALYSIS:
+                result = self.__parse_structured(
+                    self.__execute_prompt(self.__structured_prompt(text, english), ANALYSIS_SCHEMA)
+                )
+                if result is not None:
+                    return result
+
+                logger.warning(
+                    "Structured analysis has failed. Falling back to separate prompts..."
+                )
+
+            corrected_text = self.__get_corrected_translated(text, english)
             summarry = self.__get_summary(corrected_text)
             issues = self.__get_issues(corrected_text)
 
@@ -38,6 +98,60 @@ class ReviewAnalizer(metaclass=SingletonMeta):
             )
             return None
 
+    async def summarize_review_async(
+        self, text: str, english: bool = False
+    ) -> AnalizerResult | None:
+        """
+        The same as `summarize_review()`, but the prompts which do not depend on each other
+        are sent to Ollama concurrently, at most `OLLAMA_MAX_CONCURRENCY` at a time
+        """
+        try:
+            text = text.replace("\n", " ").replace("  ", " ")
+
+            if STRUCTURED_ANALYSIS:
+                result = self.__parse_structured(
+                    await self.__execute_prompt_async(
+                        self.__structured_prompt(text, english), ANALYSIS_SCHEMA
+                    )
+                )
+                if result is not None:
+                    return result
+
+                logger.warning(
+                    "Structured analysis has failed. Falling back to separate prompts..."
+                )
+
+            corrected_text = await self.__execute_prompt_async(self.__correction_prompt(text))
+            if not english:
+                corrected_text = await self.__execute_prompt_async(
+                    self.__translation_prompt(corrected_text)
+                )
+
+            (summary, string_issues) = await asyncio.gather(
+                self.__execute_prompt_async(self.__summary_prompt(corrected_text)),
+                self.__execute_prompt_async(self.__issues_prompt(corrected_text)),
+            )
+
+            issue_descriptions = self.__parse_issues(string_issues)
+            departments = await asyncio.gather(
+                *[
+                    self.__execute_prompt_async(self.__department_prompt(description))
+                    for description in issue_descriptions
+                ]
+            )
+
+            issues = [
+                Issue(description, self.__parse_department(department))
+                for description, department in zip(issue_descriptions, departments)
+            ]
+
+            return AnalizerResult(corrected_text, summary, issues)
+        except Exception as ex:
+            logger.error(
+                f"Exception catched durint review analysis: {ex} {ex.args}\n{format_exc()}"
+            )
+            return None
+
     def __ensure_existence(self, model: str):
         try:
             ollama.chat(model)
@@ -48,118 +162,210 @@ class ReviewAnalizer(metaclass=SingletonMeta):
             else:
                 print(f"Error: {e.error}")
 
-    def __get_corrected_translated(self, text: str) -> str:
-        text = text.strip(" \n")
+    def __get_corrected_translated(self, text: str, english: bool) -> str:
+        corrected = self.__execute_prompt(self.__correction_prompt(text))
 
-        corrected = str(
-            self.__execute_prompt(
-                (
-                    "I will give you a review for a restaurant. "
-                    "I want you to correct the original text of any errors or typos. "
-                    "Give me the corrected text wihout any additional text, headers, or phrases. "
-                    "Input review: "
-                    f"{text}"
-                ).strip(" \n")
-            ).message.content
-        )
+        if english:
+            return corrected
 
-        return str(
-            self.__execute_prompt(
-                (
-                    "I will give you a review for a restaurant. "
-                    "I want you to translate the review to English. "
-                    "Give me the translated text wihout any additional text, headers, or phrases. "
-                    "Input review: "
-                    f"{corrected}"
-                ).strip(" \n")
-            ).message.content
-        )
+        return self.__execute_prompt(self.__translation_prompt(corrected))
 
     def __get_summary(self, text: str) -> str:
-        text = text.strip(" \n")
-
-        return str(
-            self.__execute_prompt(
-                (
-                    "I will give you a review for a restaurant. "
-                    "I want you to make a short summary of the review. "
-                    "Give me the summary wihout any additional text, headers, or phrases. "
-                    "Input review: "
-                    f"{text}"
-                ).strip(" \n")
-            ).message.content
-        )
+        return self.__execute_prompt(self.__summary_prompt(text))
 
     def __get_issues(self, text: str) -> list[Issue]:
-        text = text.strip(" \n")
-
-        string_issues = str(
-            self.__execute_prompt(
-                (
-                    "I will give you a review for a restaurant. "
-                    "I want you to make a list of any issues the reviewer may have had with food or service. "
-                    "Give me the list of issues in details wihout any additional text, headers, or phrases. "
-                    'If you think there are no issues related to restaurants, respond with "None". '
-                    "Input review: "
-                    f"{text}"
-                ).strip(" \n")
-            ).message.content
-        ).split("\n")
+        string_issues = self.__execute_prompt(self.__issues_prompt(text))
 
         result_issues: list[Issue] = []
 
-        for str_issue in string_issues:
-            if "None" not in str_issue:
-                result_issues.append(Issue(str_issue, self.__get_issue_department(str_issue)))
+        for str_issue in self.__parse_issues(string_issues):
+            result_issues.append(Issue(str_issue, self.__get_issue_department(str_issue)))
 
         return result_issues
 
     def __get_issue_department(self, issue_description: str) -> IssueDepartment:
-        issue_description.strip(" \n")
-
-        departments_str = str(
-            self.__execute_prompt(
-                (
-                    "You are an expert in classifying customer feedback for a restaurant."
-                    "Based on the issue I will give you, assign the feedback to the most relevant department. The departments are: "
-                    "Kitchen: For issues related to food quality, taste, temperature, preparation, or presentation. "
-                    "Floor: For issues related to staff behavior, attentiveness, wait times, table service, and overall customer mood. "
-                    "Bar: For issues related to drinks, bartending, cocktails, or bar-specific service. "
-                    "Other: For feedback that does not clearly fit into any of the above categories. "
-                    "Give me the result wihout any additional text, headers, or phrases. "
-                    "Here is the issue: "
-                    f"{issue_description}"
-                ).strip(" \n")
-            ).message.content
-        ).lower()
-
-        # result: list[IssueDepartment] = []
+        return self.__parse_department(
+            self.__execute_prompt(self.__department_prompt(issue_description))
+        )
+
+    def __structured_prompt(self, text: str, english: bool) -> str:
+        text = text.strip(" \n")
+        # The transcriptions translated by Whisper are in English already
+        translation = "" if english else " and translate it to English"
+
+        return (
+            "I will give you a review for a restaurant. "
+            f"Correct the original text of any errors or typos{translation}, "
+            "then make a short summary of the review. "
+            "Then make a list of any issues the reviewer may have had with food or service, "
+            "described in details. "
+            "If there are no issues related to restaurants, leave the list empty. "
+            "Assign every issue to the most relevant department: "
+            "kitchen: for issues related to food quality, taste, temperature, preparation, "
+            "or presentation; "
+            "floor: for issues related to staff behavior, attentiveness, wait times, "
+            "table service, and overall customer mood; "
+            "bar: for issues related to drinks, bartending, cocktails, or bar-specific service; "
+            "other: for feedback that does not clearly fit into any of the above categories. "
+            "Respond in JSON. "
+            "Input review: "
+            f"{text}"
+        ).strip(" \n")
+
+    def __correction_prompt(self, text: str) -> str:
+        text = text.strip(" \n")
+
+        return (
+            "I will give you a review for a restaurant. "
+            "I want you to correct the original text of any errors or typos. "
+            "Give me the corrected text wihout any additional text, headers, or phrases. "
+            "Input review: "
+            f"{text}"
+        ).strip(" \n")
+
+    def __translation_prompt(self, text: str) -> str:
+        return (
+            "I will give you a review for a restaurant. "
+            "I want you to translate the review to English. "
+            "Give me the translated text wihout any additional text, headers, or phrases. "
+            "Input review: "
+            f"{text}"
+        ).strip(" \n")
+
+    def __summary_prompt(self, text: str) -> str:
+        text = text.strip(" \n")
+
+        return (
+            "I will give you a review for a restaurant. "
+            "I want you to make a short summary of the review. "
+            "Give me the summary wihout any additional text, headers, or phrases. "
+            "Input review: "
+            f"{text}"
+        ).strip(" \n")
+
+    def __issues_prompt(self, text: str) -> str:
+        text = text.strip(" \n")
+
+        return (
+            "I will give you a review for a restaurant. "
+            "I want you to make a list of any issues the reviewer may have had with food or service. "
+            "Give me the list of issues in details wihout any additional text, headers, or phrases. "
+            'If you think there are no issues related to restaurants, respond with "None". '
+            "Input review: "
+            f"{text}"
+        ).strip(" \n")
+
+    def __department_prompt(self, issue_description: str) -> str:
+        return (
+            "You are an expert in classifying customer feedback for a restaurant."
+            "Based on the issue I will give you, assign the feedback to the most relevant department. The departments are: "
+            "Kitchen: For issues related to food quality, taste, temperature, preparation, or presentation. "
+            "Floor: For issues related to staff behavior, attentiveness, wait times, table service, and overall customer mood. "
+            "Bar: For issues related to drinks, bartending, cocktails, or bar-specific service. "
+            "Other: For feedback that does not clearly fit into any of the above categories. "
+            "Give me the result wihout any additional text, headers, or phrases. "
+            "Here is the issue: "
+            f"{issue_description}"
+        ).strip(" \n")
+
+    def __parse_structured(self, response: str) -> AnalizerResult | None:
+        """Returns `None` if the response does not match `ANALYSIS_SCHEMA`"""
+        try:
+            parsed = json.loads(response)
+
+            issues = [
+                Issue(
+                    str(issue["description"]).strip(" \n"),
+                    IssueDepartment(str(issue["department"]).lower()),
+                )
+                for issue in parsed["issues"]
+                if str(issue["description"]).strip(" \n") != ""
+            ]
+
+            return AnalizerResult(
+                str(parsed["corrected_text"]).strip(" \n"),
+                str(parsed["summary"]).strip(" \n"),
+                issues,
+            )
+        except (ValueError, KeyError, TypeError) as ex:
+            logger.warning("Could not parse the structured analysis: %s %s", ex, ex.args)
+            return None
+
+    def __parse_issues(self, string_issues: str) -> list[str]:
+        return [str_issue for str_issue in string_issues.split("\n") if "None" not in str_issue]
+
+    def __parse_department(self, departments_str: str) -> IssueDepartment:
+        departments_str = departments_str.lower()
 
         for department in list(IssueDepartment):
             if department.value in departments_str:
                 return department
 
         return IssueDepartment.OTHER
-        # result.append(department)
 
-        # return result
-
-    def __execute_prompt(self, prompt: str) -> ollama.ChatResponse:
-        logger.debug(f"Prompting:\n{prompt}\n-----")
-
-        result = ollama.chat(
-            model=MODEL,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-        )
-
-        logger.debug(f"Response:\n{result.message.content}\n-----")
+    def __execute_prompt(self, prompt: str, response_format: dict | None = None) -> str:
+        # The prompt and its response are logged together, or not at all
+        log_payloads = sample_payload(logger)
+
+        cached = self.__prompt_cache.get(MODEL, prompt, response_format)
+        if cached is not None:
+            if log_payloads:
+                logger.debug("Using cached response for prompt:\n%s\n-----", LogPayload(prompt))
+            return cached
+
+        if log_payloads:
+            logger.debug("Prompting:\n%s\n-----", LogPayload(prompt))
+
+        with STAGE_DURATION.labels("llm").time():
+            result = ollama.chat(
+                model=MODEL,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                format=response_format,
+            )
 
-        return result
+        if log_payloads:
+            logger.debug("Response:\n%s\n-----", LogPayload(result.message.content))
+
+        self.__prompt_cache.put(MODEL, prompt, str(result.message.content), response_format)
+        return str(result.message.content)
+
+    async def __execute_prompt_async(self, prompt: str, response_format: dict | None = None) -> str:
+        # The prompt and its response are logged together, or not at all
+        log_payloads = sample_payload(logger)
+
+        cached = self.__prompt_cache.get(MODEL, prompt, response_format)
+        if cached is not None:
+            if log_payloads:
+                logger.debug("Using cached response for prompt:\n%s\n-----", LogPayload(prompt))
+            return cached
+
+        async with self.__prompt_slots:
+            if log_payloads:
+                logger.debug("Prompting:\n%s\n-----", LogPayload(prompt))
+
+            # Timed inside the slot, so the wait for a free slot is not counted
+            with STAGE_DURATION.labels("llm").time():
+                result = await self.__async_client.chat(
+                    model=MODEL,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    format=response_format,
+                )
+
+        if log_payloads:
+            logger.debug("Response:\n%s\n-----", LogPayload(result.message.content))
+
+        self.__prompt_cache.put(MODEL, prompt, str(result.message.content), response_format)
+        return str(result.message.content)
 
 
 # # MODEL = "llama3.1:8b"
@@ -0,0 +1,331 @@
+import os
+import multiprocessing
+
+from itertools import count
+from logging import getLogger
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from time import sleep
+from time import time as getTime
+from traceback import format_exc
+from typing import Any, Iterator, NamedTuple
+
+from modules.ais.audio_preprocessor import BufferedAudio, audio_duration
+from modules.log import current_log_queue, setup_custom_logger
+from settings import (
+    LOGGER_NAME,
+    TORCH_INTRA_OP_THREADS,
+    TRANSCRIPTION_PROCESS_CORES,
+    TRANSCRIPTION_PROCESS_DEVICES,
+    TRANSCRIPTION_HEALTH_INTERVAL,
+    TRANSCRIPTION_HEALTH_TIMEOUT,
+    TRANSCRIPTION_REQUEST_TIMEOUT,
+    TRANSCRIPTION_REQUEST_SECONDS_PER_AUDIO_SECOND,
+    SCHEDULER_UNKNOWN_DURATION,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class PoolMessage(NamedTuple):
+    # `None` for the messages which are not about a request
+    request_id: int | None
+    worker: int
+    # "ready", "heartbeat", "chunk", "done", "error", or "lost" if the worker has died
+    kind: str
+    value: Any = None
+
+
+class TranscriptionRequest(NamedTuple):
+    request_id: int
+    # "batch" or "stream"
+    kind: str
+    audios: list[Path | BufferedAudio]
+
+
+def run_transcription_worker(
+    index: int, cores: list[int] | None, device: str | None, requests, results, log_queue
+) -> None:
+    """
+    The main function of a transcription worker process.
+
+    Pins the process to its cores and device before the model is loaded,
+    then transcribes the requests one at a time.
+    """
+    if device == "cpu":
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    elif device is not None and device.startswith("cuda:"):
+        # Every worker sees only its own GPU, as the first one
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.removeprefix("cuda:")
+
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    # The process is spawned, so it does not inherit the logging of the reviewing process
+    if log_queue is not None:
+        setup_custom_logger(LOGGER_NAME, log_queue)
+
+    # Started before the model is loaded, so a slow start is not taken for a hang.
+    # They only tell that the process is alive, a request stuck in the model
+    # is caught by its deadline in the pool
+    def send_heartbeats() -> None:
+        while True:
+            results.put(PoolMessage(None, index, "heartbeat"))
+            sleep(TRANSCRIPTION_HEALTH_INTERVAL)
+
+    Thread(target=send_heartbeats, name="heartbeat", daemon=True).start()
+
+    import torch
+    from modules.ais.audio_transcriber import AudioTranscriber
+
+    if cores and TORCH_INTRA_OP_THREADS is None:
+        # One torch thread per core of the worker, so the workers do not compete for the cores
+        torch.set_num_threads(len(cores))
+
+    logger.info(
+        "Transcription worker #%d is loading the model on cores %s, device %s", index, cores, device
+    )
+
+    transcriber = AudioTranscriber()
+
+    results.put(PoolMessage(None, index, "ready"))
+
+    while True:
+        request: TranscriptionRequest = requests.get()
+
+        try:
+            if request.kind == "stream":
+                for text in transcriber.transcribe_stream(request.audios[0]):
+                    results.put(PoolMessage(request.request_id, index, "chunk", text))
+
+                results.put(PoolMessage(request.request_id, index, "done"))
+            else:
+                results.put(
+                    PoolMessage(
+                        request.request_id,
+                        index,
+                        "done",
+                        transcriber.transcribe_batch(request.audios),
+                    )
+                )
+        except Exception as ex:
+            logger.error(
+                f"Exception catched durint audio transcription: {ex} {ex.args}\n{format_exc()}"
+            )
+            results.put(PoolMessage(request.request_id, index, "error", f"{ex}"))
+
+
+class TranscriptionWorkerLost(Exception):
+    pass
+
+
+class TranscriptionPool:
+    """
+    Transcribes recordings in several worker processes, each with its own model instance.
+
+    A request goes to a worker which is free, and waits until one is. Workers report their health
+    with heartbeats, and every request has a deadline based on the length of its audio.
+    A worker which has died, stopped responding, or missed the deadline of its request
+    is restarted, failing the request it was working on.
+    Offers the same `transcribe_batch()` and `transcribe_stream()` as `AudioTranscriber`.
+    """
+
+    def __init__(self, processes: int) -> None:
+        # Spawned, so the workers do not inherit the threads and the torch state of this process
+        self.__context = multiprocessing.get_context("spawn")
+        self.__results = self.__context.Queue()
+        self.__lock = Lock()
+        self.__request_ids = count()
+
+        self.__processes: list[Any] = [None] * processes
+        self.__requests: list[Any] = [None] * processes
+        self.__heartbeats: list[float] = [0.0] * processes
+        # Id of the request every worker is working on, and when it has to be done by
+        self.__in_flight: list[int | None] = [None] * processes
+        self.__deadlines: list[float | None] = [None] * processes
+        # Replies of the workers routed to the waiting requests
+        self.__replies: dict[int, Queue[PoolMessage]] = {}
+        # Workers ready for a request, each one at most once
+        self.__idle: Queue[int] = Queue()
+        self.__is_idle: list[bool] = [False] * processes
+
+        cores = TRANSCRIPTION_PROCESS_CORES or self.__split_cores(processes)
+        self.__cores = [cores[index % len(cores)] if cores else None for index in range(processes)]
+        self.__devices = [
+            TRANSCRIPTION_PROCESS_DEVICES[index % len(TRANSCRIPTION_PROCESS_DEVICES)]
+            if TRANSCRIPTION_PROCESS_DEVICES
+            else None
+            for index in range(processes)
+        ]
+
+        for index in range(processes):
+            self.__requests[index] = self.__context.Queue()
+            self.__start_worker(index)
+
+        Thread(target=self.__route_results, name="pool-results", daemon=True).start()
+        Thread(target=self.__check_health, name="pool-health", daemon=True).start()
+
+    def transcribe_batch(self, audios: list[Path | BufferedAudio]) -> list[str | None]:
+        try:
+            for message in self.__request("batch", audios):
+                return message.value
+        except Exception as ex:
+            logger.error(f"Exception catched durint batch transcription: {ex} {ex.args}")
+
+        return [None] * len(audios)
+
+    def transcribe_stream(self, audio: Path | BufferedAudio) -> Iterator[str]:
+        """Raises if the transcription has failed, after the chunks transcribed so far"""
+        for message in self.__request("stream", [audio]):
+            if message.kind == "chunk":
+                yield message.value
+
+    def __request(self, kind: str, audios: list[Path | BufferedAudio]) -> Iterator[PoolMessage]:
+        """Yields the chunks and the final result of the request, raises if the request fails"""
+        request_id = next(self.__request_ids)
+        replies: Queue[PoolMessage] = Queue()
+        time_limit = self.__time_limit(audios)
+
+        # Blocks until a worker is free
+        worker = self.__idle.get()
+
+        with self.__lock:
+            self.__is_idle[worker] = False
+            self.__replies[request_id] = replies
+            self.__in_flight[worker] = request_id
+            self.__deadlines[worker] = getTime() + time_limit
+            self.__requests[worker].put(TranscriptionRequest(request_id, kind, audios))
+
+        try:
+            while True:
+                message = replies.get()
+
+                if message.kind == "lost":
+                    raise TranscriptionWorkerLost(f"Transcription worker #{worker} has been lost")
+
+                if message.kind == "error":
+                    raise RuntimeError(message.value)
+
+                yield message
+
+                if message.kind == "done":
+                    return
+        finally:
+            with self.__lock:
+                self.__replies.pop(request_id, None)
+
+    def __start_worker(self, index: int) -> None:
+        with self.__lock:
+            self.__heartbeats[index] = getTime()
+
+            self.__processes[index] = self.__context.Process(
+                target=run_transcription_worker,
+                args=(
+                    index,
+                    self.__cores[index],
+                    self.__devices[index],
+                    self.__requests[index],
+                    self.__results,
+                    current_log_queue(),
+                ),
+                name=f"Transcription worker #{index}",
+                daemon=True,
+            )
+
+        self.__processes[index].start()
+
+    def __release(self, worker: int) -> None:
+        with self.__lock:
+            self.__in_flight[worker] = None
+            self.__deadlines[worker] = None
+            if self.__is_idle[worker]:
+                return
+            self.__is_idle[worker] = True
+
+        self.__idle.put(worker)
+
+    def __route_results(self) -> None:
+        while True:
+            message: PoolMessage = self.__results.get()
+
+            with self.__lock:
+                self.__heartbeats[message.worker] = getTime()
+                replies = (
+                    self.__replies.get(message.request_id)
+                    if message.request_id is not None
+                    else None
+                )
+
+            if message.kind == "ready":
+                logger.info("Transcription worker #%d is ready", message.worker)
+            elif replies is not None:
+                replies.put(message)
+
+            # Released here rather than by the request, so a stream which is not read to the end
+            # does not keep its worker
+            if message.kind in ("ready", "done", "error"):
+                self.__release(message.worker)
+
+    def __check_health(self) -> None:
+        while True:
+            sleep(TRANSCRIPTION_HEALTH_INTERVAL)
+
+            for index, process in enumerate(self.__processes):
+                with self.__lock:
+                    silent_for = getTime() - self.__heartbeats[index]
+                    deadline = self.__deadlines[index]
+
+                if not process.is_alive():
+                    problem = f"died with code {process.exitcode}"
+                elif silent_for >= TRANSCRIPTION_HEALTH_TIMEOUT:
+                    problem = "stopped responding"
+                elif deadline is not None and getTime() > deadline:
+                    problem = "missed the deadline of its request"
+                else:
+                    continue
+
+                logger.error("Transcription worker #%d has %s, restarting it...", index, problem)
+
+                if process.is_alive():
+                    process.kill()
+                process.join()
+
+                with self.__lock:
+                    request_id = self.__in_flight[index]
+                    self.__in_flight[index] = None
+                    self.__deadlines[index] = None
+                    replies = self.__replies.get(request_id) if request_id is not None else None
+                    # A new queue, so the new process does not get the request of the lost one,
+                    # while a request which takes the worker from now on waits for the new process
+                    self.__requests[index] = self.__context.Queue()
+
+                if replies is not None:
+                    replies.put(PoolMessage(request_id, index, "lost"))
+
+                self.__start_worker(index)
+
+    def __time_limit(self, audios: list[Path | BufferedAudio]) -> float:
+        """How long a worker may take to transcribe the recordings, before it is taken for hung"""
+        seconds = 0.0
+
+        for audio in audios:
+            duration = audio_duration(audio)
+            seconds += duration if duration is not None else SCHEDULER_UNKNOWN_DURATION
+
+        return (
+            TRANSCRIPTION_REQUEST_TIMEOUT + seconds * TRANSCRIPTION_REQUEST_SECONDS_PER_AUDIO_SECOND
+        )
+
+    def __split_cores(self, processes: int) -> list[list[int]]:
+        """Splits the cores this process may run on evenly between the workers"""
+        if not hasattr(os, "sched_getaffinity"):
+            return []
+
+        available = sorted(os.sched_getaffinity(0))
+        share = len(available) // processes
+        if share == 0:
+            return []
+
+        return [available[index * share : (index + 1) * share] for index in range(processes)]
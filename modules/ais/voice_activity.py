@@ -0,0 +1,116 @@
+import numpy as np
+
+from settings import (
+    VAD_FRAME_SECONDS,
+    VAD_MIN_ENERGY_DB,
+    VAD_ENERGY_MARGIN_DB,
+    VAD_SPEECH_ENERGY_DB,
+    VAD_MAX_ZERO_CROSSING_RATE,
+    VAD_MIN_REGION_SECONDS,
+    VAD_MAX_GAP_SECONDS,
+    VAD_PADDING_SECONDS,
+)
+
+
+class VoiceActivity:
+    def __init__(
+        self, speech_ratio: float, speech_seconds: float, regions: list[tuple[int, int]]
+    ) -> None:
+        self.speech_ratio = speech_ratio
+        self.speech_seconds = speech_seconds
+        # (start, end) sample indices of the voiced parts of the audio
+        self.regions = regions
+
+
+class VoiceActivityDetector:
+    """
+    A cheap energy and zero-crossing based voice activity detector.
+
+    The audio is split into frames, and a frame is considered voiced if it is louder
+    than both an absolute floor and the estimated noise floor of the recording,
+    and does not cross zero as often as hiss or static does. Frames louder than an absolute
+    speech level always pass the energy check, so continuous speech is not taken for noise.
+    Everything is computed over all frames at once with NumPy.
+    """
+
+    def __init__(self, sampling_rate: int) -> None:
+        self.__sampling_rate = sampling_rate
+        self.__frame_length = int(sampling_rate * VAD_FRAME_SECONDS)
+
+    def detect(self, samples: np.ndarray) -> VoiceActivity:
+        frames_count = len(samples) // self.__frame_length
+        if frames_count == 0:
+            return VoiceActivity(0.0, 0.0, [])
+
+        frames = samples[: frames_count * self.__frame_length].reshape(
+            frames_count, self.__frame_length
+        )
+
+        energy_db = 10 * np.log10(np.mean(frames**2, axis=1) + 1e-10)
+        zero_crossing_rate = np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1)
+
+        # The quietest frames are taken for the noise between the words. Without pauses they are
+        # speech themselves, so the threshold never goes above the absolute speech level
+        noise_floor_db = np.percentile(energy_db, 10)
+        threshold_db = min(
+            max(noise_floor_db + VAD_ENERGY_MARGIN_DB, VAD_MIN_ENERGY_DB), VAD_SPEECH_ENERGY_DB
+        )
+
+        voiced = (energy_db > threshold_db) & (
+            (zero_crossing_rate < VAD_MAX_ZERO_CROSSING_RATE)
+            # Loud frames are speech even if they are noisy, e.g. fricatives
+            | (energy_db > threshold_db + VAD_ENERGY_MARGIN_DB)
+        )
+
+        regions = self.__to_regions(voiced)
+        voiced_frames = sum(end - start for start, end in regions)
+
+        return VoiceActivity(
+            voiced_frames / frames_count,
+            voiced_frames * self.__frame_length / self.__sampling_rate,
+            [
+                (start * self.__frame_length, end * self.__frame_length)
+                for start, end in self.__pad(regions, frames_count)
+            ],
+        )
+
+    def trim(self, samples: np.ndarray, activity: VoiceActivity) -> np.ndarray:
+        """Returns only the voiced parts of the audio, joined together"""
+        if len(activity.regions) == 0:
+            return samples[:0]
+
+        return np.concatenate([samples[start:end] for start, end in activity.regions])
+
+    def __to_regions(self, voiced: np.ndarray) -> list[tuple[int, int]]:
+        # Indices where voiced runs start and end
+        edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        max_gap = int(VAD_MAX_GAP_SECONDS / VAD_FRAME_SECONDS)
+        min_length = int(VAD_MIN_REGION_SECONDS / VAD_FRAME_SECONDS)
+
+        # Join the runs separated by short pauses
+        merged: list[tuple[int, int]] = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if merged and start - merged[-1][1] <= max_gap:
+                merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+
+        # Drop the clicks and bumps too short to be speech
+        return [(start, end) for start, end in merged if end - start >= min_length]
+
+    def __pad(self, regions: list[tuple[int, int]], frames_count: int) -> list[tuple[int, int]]:
+        padding = int(VAD_PADDING_SECONDS / VAD_FRAME_SECONDS)
+
+        padded: list[tuple[int, int]] = []
+        for start, end in regions:
+            start, end = max(start - padding, 0), min(end + padding, frames_count)
+
+            if padded and start <= padded[-1][1]:
+                padded[-1] = (padded[-1][0], end)
+            else:
+                padded.append((start, end))
+
+        return padded
@@ -9,10 +9,21 @@ ATTACHEMENT_DENIED = "Sorry, I can accept only text or Voice Notes 🎙"
 FILETYPE_DENIED = "Sorry, I can accept only text or Voice Notes 🎙"
 
 REVIEW_ACCEPTED = "Thank you for your feedback! ❤️ \n\nGive me some time to analize your review. 🫶🏼"
+REVIEW_ACCEPTED_WITH_ETA = (
+    "Thank you for your feedback! ❤️ \n\nThere are a few reviews ahead of yours, "
+    "I will get back to you in about {minutes} min. 🫶🏼"
+)
+REVIEW_DEFERRED = (
+    "Thank you for your feedback! ❤️ \n\nI am receiving a lot of reviews right now, "
+    "so yours will take a while. I will get back to you as soon as it is analized. 🫶🏼"
+)
+
+TRANSCRIPTION_IN_PROGRESS = "Listening to your review... 🎧"
 
 TRANSCRIPTION_ERROR = (
     "Sorry, there was a problem with transcribing your review. Could you please try again?"
 )
+NO_SPEECH = "Sorry, I could not hear anything in your Voice Note 🎙 Could you please try again?"
 UPLOAD_ERROR = "Sorry, there was a problem with saving your review. Could you please try again?"
 
 TRANSCRIPTION_DONE_WITH_ISSUES = (
@@ -0,0 +1,240 @@
+import asyncio
+
+from collections import OrderedDict, deque
+from datetime import timedelta
+from enum import Enum
+from logging import getLogger
+from pathlib import Path
+from traceback import format_exc
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from settings import (
+    LOGGER_NAME,
+    TELEGRAM_MESSAGES_PER_SECOND,
+    TELEGRAM_CHAT_MESSAGE_INTERVAL,
+    TELEGRAM_SEND_MAX_ATTEMPTS,
+    TELEGRAM_SEND_RETRY_DELAY,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+# Telegram refuses longer text messages
+MESSAGE_LIMIT = 4096
+# progress messages which can still be edited
+PROGRESS_MESSAGES_LIMIT = 1024
+
+
+class OutboundKind(Enum):
+    TEXT = "text"
+    PHOTO = "photo"
+    PROGRESS = "progress"
+
+
+class OutboundMessage:
+    def __init__(
+        self,
+        kind: OutboundKind,
+        chat_id: int,
+        text: str,
+        reply_to_message_id: int | None = None,
+        photo_path: Path | None = None,
+    ) -> None:
+        self.kind = kind
+        self.chat_id = chat_id
+        self.text = text
+        # Progress messages of a job are edited in place,
+        # they are told apart by the message they reply to
+        self.reply_to_message_id = reply_to_message_id
+        self.photo_path = photo_path
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """
+    Delivers the messages of the bot from its own event loop, without blocking the caller.
+
+    Messages of every chat are sent in order, one at a time,
+    at most one per `TELEGRAM_CHAT_MESSAGE_INTERVAL`
+    seconds, and at most `TELEGRAM_MESSAGES_PER_SECOND` over all the chats. Messages queued while
+    a chat waits for its turn are merged: successive texts are joined, and only the latest progress
+    is sent. Network errors and flood limits are retried, other errors drop the message.
+    """
+
+    def __init__(self, bot: Bot) -> None:
+        self.__bot = bot
+        self.__loop: asyncio.AbstractEventLoop | None = None
+        self.__pending: dict[int, deque[OutboundMessage]] = {}
+        self.__deliveries: dict[int, asyncio.Task] = {}
+        self.__chat_next_send_at: dict[int, float] = {}
+        self.__next_send_at = 0.0
+        self.__progress_message_ids: OrderedDict[tuple[int, int | None], int] = OrderedDict()
+
+    def start(self) -> None:
+        """Binds the queue to the running event loop of the bot"""
+        self.__loop = asyncio.get_running_loop()
+
+    def send_message(self, chat_id: int, text: str, reply_to_message_id: int | None = None) -> None:
+        self.__submit(OutboundMessage(OutboundKind.TEXT, chat_id, text, reply_to_message_id))
+
+    def send_photo(self, chat_id: int, photo_path: Path, caption: str) -> None:
+        self.__submit(OutboundMessage(OutboundKind.PHOTO, chat_id, caption, photo_path=photo_path))
+
+    def show_progress(
+        self, chat_id: int, text: str, reply_to_message_id: int | None = None
+    ) -> None:
+        """Sends the progress the first time, and edits the same message afterwards"""
+        self.__submit(OutboundMessage(OutboundKind.PROGRESS, chat_id, text, reply_to_message_id))
+
+    def __submit(self, message: OutboundMessage) -> None:
+        if self.__loop is None:
+            raise RuntimeError("The outbound queue has not been started")
+
+        # Can be called from any thread, the queue itself is only touched from the event loop
+        self.__loop.call_soon_threadsafe(self.__enqueue, message)
+
+    def __enqueue(self, message: OutboundMessage) -> None:
+        pending = self.__pending.setdefault(message.chat_id, deque())
+
+        if len(pending) == 0 or not self.__merge(pending[-1], message):
+            pending.append(message)
+
+        if message.chat_id not in self.__deliveries:
+            self.__deliveries[message.chat_id] = asyncio.get_running_loop().create_task(
+                self.__deliver(message.chat_id)
+            )
+
+    def __merge(self, last: OutboundMessage, message: OutboundMessage) -> bool:
+        if last.kind is not message.kind or last.reply_to_message_id != message.reply_to_message_id:
+            return False
+
+        if message.kind is OutboundKind.PROGRESS:
+            last.text = message.text
+            return True
+
+        if (
+            message.kind is OutboundKind.TEXT
+            and len(last.text) + len(message.text) + 2 <= MESSAGE_LIMIT
+        ):
+            last.text = f"{last.text}\n\n{message.text}"
+            return True
+
+        return False
+
+    async def __deliver(self, chat_id: int) -> None:
+        pending = self.__pending[chat_id]
+
+        try:
+            while len(pending) > 0:
+                # The message is taken only when it is its turn,
+                # so the ones queued meanwhile are merged into it
+                await self.__wait_turn(chat_id)
+                message = pending.popleft()
+
+                if not await self.__send(message):
+                    pending.appendleft(message)
+        finally:
+            # Nothing is awaited between the last check and here, so no message is left behind
+            del self.__deliveries[chat_id]
+            if len(pending) == 0:
+                del self.__pending[chat_id]
+
+    async def __wait_turn(self, chat_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+
+        send_at = max(now, self.__next_send_at, self.__chat_next_send_at.get(chat_id, 0.0))
+        # The slot is reserved before sleeping, so the chats waiting at the same time are spread out
+        self.__next_send_at = send_at + 1 / TELEGRAM_MESSAGES_PER_SECOND
+        self.__chat_next_send_at[chat_id] = send_at + TELEGRAM_CHAT_MESSAGE_INTERVAL
+
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+    async def __send(self, message: OutboundMessage) -> bool:
+        """Returns `False` if the message should be sent again"""
+        message.attempts += 1
+
+        try:
+            await self.__send_once(message)
+            return True
+
+        except RetryAfter as ex:
+            retry_after = ex.retry_after
+            delay = (
+                retry_after.total_seconds()
+                if isinstance(retry_after, timedelta)
+                else float(retry_after)
+            )
+            logger.warning(
+                "Telegram flood limit reached, pausing the outbound messages for %s seconds", delay
+            )
+
+            # The flood limit applies to the whole bot
+            self.__next_send_at = asyncio.get_running_loop().time() + delay
+            return False
+
+        except BadRequest as ex:
+            # Editing a progress message with the same text
+            if "not modified" not in str(ex):
+                logger.error(f"Telegram refused a message to chat {message.chat_id}: {ex}")
+            return True
+
+        except NetworkError as ex:
+            if message.attempts >= TELEGRAM_SEND_MAX_ATTEMPTS:
+                logger.error(
+                    "A message to chat %s failed %d times, giving up: %s",
+                    message.chat_id,
+                    message.attempts,
+                    ex,
+                )
+                return True
+
+            delay = TELEGRAM_SEND_RETRY_DELAY * 2 ** (message.attempts - 1)
+            logger.warning(
+                "A message to chat %s failed, retrying in %s seconds: %s",
+                message.chat_id,
+                delay,
+                ex,
+            )
+
+            self.__chat_next_send_at[message.chat_id] = asyncio.get_running_loop().time() + delay
+            return False
+
+        except TelegramError as ex:
+            logger.error(f"Telegram refused a message to chat {message.chat_id}: {ex}")
+            return True
+
+        except Exception as ex:
+            logger.error(
+                f"Exception catched durint message delivery: {ex} {ex.args}\n{format_exc()}"
+            )
+            return True
+
+    async def __send_once(self, message: OutboundMessage) -> None:
+        if message.kind is OutboundKind.PHOTO and message.photo_path is not None:
+            with open(message.photo_path, "rb") as image:
+                await self.__bot.send_photo(message.chat_id, image, caption=message.text)
+            return
+
+        progress_key = (message.chat_id, message.reply_to_message_id)
+
+        if message.kind is OutboundKind.PROGRESS and progress_key in self.__progress_message_ids:
+            await self.__bot.edit_message_text(
+                message.text,
+                chat_id=message.chat_id,
+                message_id=self.__progress_message_ids[progress_key],
+            )
+            return
+
+        sent: Message = await self.__bot.send_message(
+            message.chat_id, message.text, reply_to_message_id=message.reply_to_message_id
+        )
+
+        if message.kind is OutboundKind.PROGRESS:
+            self.__progress_message_ids[progress_key] = sent.id
+
+            while len(self.__progress_message_ids) > PROGRESS_MESSAGES_LIMIT:
+                self.__progress_message_ids.popitem(last=False)
@@ -1,3 +1,4 @@
+import math
 import asyncio
 import traceback
 import json
@@ -6,8 +7,9 @@ import json
 from pathlib import Path
 from logging import getLogger
 from time import time as getTime
+from concurrent.futures import ThreadPoolExecutor
 
-from telegram import Update, File, Message
+from telegram import Update, File
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,9 +20,20 @@ from telegram.ext import (
 )
 
 from . import bot_replies
+from .outbound_queue import OutboundQueue
 from modules.reviewing.review_context import ReviewQueues
+from modules.reviewing.review_job import ReviewReply
+from modules.reviewing.review_replies import ReplyListener
 from modules.reviewing.bot_strategy import BotReviewStrategy, UserDialog
-from settings import TELEGRAM_AUDIO_DIR, LOGGER_NAME
+from modules.reviewing.admission_control import AdmissionControl
+from modules.ais.audio_preprocessor import persist_recording
+from settings import (
+    TELEGRAM_AUDIO_DIR,
+    TELEGRAM_CONCURRENT_UPDATES,
+    TELEGRAM_ARCHIVE_RECORDINGS,
+    LOGGER_NAME,
+    ADMISSION_ETA_NOTICE,
+)
 from keys import TELEGRAM_BOT_TOKEN
 
 
@@ -28,35 +41,45 @@ logger__ = getLogger(LOGGER_NAME)
 
 
 class TelegramUserDialog(UserDialog):
-    def __init__(self, event_loop: asyncio.AbstractEventLoop, message: Message) -> None:
-        self.event_loop = event_loop
-        self.__message = message
+    """Queues the messages of a review for the `OutboundQueue`, never waiting for Telegram"""
+
+    def __init__(self, outbound: OutboundQueue, chat_id: int, message_id: int | None) -> None:
+        self.__outbound = outbound
+        self.__chat_id = chat_id
+        self.__message_id = message_id
 
     def send_message(self, message: str) -> None:
-        self.__async_to_sync(
-            self.__message.reply_text(message, reply_to_message_id=self.__message.id)
-        )
+        self.__outbound.send_message(self.__chat_id, message, reply_to_message_id=self.__message_id)
 
     def send_image(self, image_path: Path) -> None:
-        with open(image_path, "rb") as image:
-            self.__async_to_sync(self.__message.reply_photo(image, caption=bot_replies.START_REPLY))
+        self.__outbound.send_photo(self.__chat_id, image_path, caption=bot_replies.START_REPLY)
 
-    def __async_to_sync(self, awaitable_target):
-        # loop = asyncio.new_event_loop()
-        # self.event_loop.create_task(awaitable_target()).add_done_callback(lambda t: print("Done"))
-        # loop.close()
-        return asyncio.run_coroutine_threadsafe(awaitable_target, self.event_loop).result()
+    def show_progress(self, message: str) -> None:
+        self.__outbound.show_progress(
+            self.__chat_id, message, reply_to_message_id=self.__message_id
+        )
 
 
 class TelegramBot:
     def __init__(self, review_queues: ReviewQueues) -> None:
         self.__review_queues = review_queues
+        # The downloaded voice notes are written to the disk one at a time, off the event loop
+        self.__persister = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="recording-persister"
+        )
 
     def run_telegram_bot(self):
         """Starts the Telegram bot in a blocking manner"""
 
         # Initialize Application instead of Updater
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .post_init(self.__post_init)
+            # A slow download in one chat does not hold the other chats up
+            .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+            .build()
+        )
 
         # Add handlers
         application.add_handler(CommandHandler("start", self.__start))
@@ -71,6 +94,20 @@ class TelegramBot:
         # Start polling the bot
         application.run_polling()
 
+    async def __post_init(self, application: Application) -> None:
+        # Replies of the reviewing process are delivered from the bot's event loop
+        self.__outbound = OutboundQueue(application.bot)
+        self.__outbound.start()
+
+        ReplyListener(
+            self.__review_queues.reply_queues[BotReviewStrategy.SOURCE], self.__make_strategy
+        ).start()
+
+    def __make_strategy(self, reply: ReviewReply) -> BotReviewStrategy:
+        return BotReviewStrategy(
+            TelegramUserDialog(self.__outbound, int(reply.chat_id or 0), reply.message_id)
+        )
+
     async def __start(self, update: Update, context: CallbackContext):
         if update.message is None:
             logger__.warning("Update does not contain Message", stack_info=True)
@@ -126,19 +163,33 @@ class TelegramBot:
         # Wait for file info to be received
         file_info: File = await file_info_await
 
-        # Reply to the user that his audio has been received
-        reply_await = update.message.reply_text(bot_replies.REVIEW_ACCEPTED)
+        # Reply to the user that his audio has been received.
+        # The backlog is read from SQLite, so it is done off the event loop,
+        # like every access to the journal
+        reply_await = update.message.reply_text(await asyncio.to_thread(self.__acceptance_reply))
 
-        # Download the file
+        # Download the file into memory, the reviewer works from the downloaded bytes
         file_path = TELEGRAM_AUDIO_DIR / new_file_name
-        await file_info.download_to_drive(file_path.absolute().as_posix())
+        audio: bytes | None = bytes(await file_info.download_as_bytearray())
+
+        if not await asyncio.to_thread(AdmissionControl().hold_in_memory):
+            # The recordings wait in the queues for long under a backlog,
+            # so only their paths are held
+            if await asyncio.get_running_loop().run_in_executor(
+                self.__persister, persist_recording, file_path, audio, False
+            ):
+                audio = None
+        elif TELEGRAM_ARCHIVE_RECORDINGS and audio is not None:
+            self.__persister.submit(persist_recording, file_path, audio)
 
         # Transcribe it, and upload it
-        self.__review_queues.audio_queue.put(
-            (
-                BotReviewStrategy(TelegramUserDialog(asyncio.get_running_loop(), update.message)),
-                file_path,
-            )
+        await asyncio.to_thread(
+            self.__review_queues.put_audio,
+            BotReviewStrategy.SOURCE,
+            file_path,
+            update.message.chat_id,
+            update.message.id,
+            audio,
         )
 
         # Wait for the reply to be delivered
@@ -154,18 +205,33 @@ class TelegramBot:
             return
 
         # Reply to the user that his audio has been received
-        reply_await = update.message.reply_text(bot_replies.REVIEW_ACCEPTED)
+        reply_await = update.message.reply_text(await asyncio.to_thread(self.__acceptance_reply))
 
         # Transcribe it, and upload it
-        self.__review_queues.text_queue.put(
-            (
-                BotReviewStrategy(TelegramUserDialog(asyncio.get_running_loop(), update.message)),
-                update.message.text,
-            )
+        await asyncio.to_thread(
+            self.__review_queues.put_text,
+            BotReviewStrategy.SOURCE,
+            update.message.text,
+            update.message.chat_id,
+            update.message.id,
         )
 
         await reply_await
 
+    def __acceptance_reply(self) -> str:
+        """Tells the user how long the review is going to take, if it is going to take long"""
+        admission = AdmissionControl()
+
+        # Reviews of users are never refused, they are only told that the answer will be late
+        if admission.overloaded():
+            return bot_replies.REVIEW_DEFERRED
+
+        drain_seconds = admission.backlog().drain_seconds
+        if drain_seconds <= ADMISSION_ETA_NOTICE:
+            return bot_replies.REVIEW_ACCEPTED
+
+        return bot_replies.REVIEW_ACCEPTED_WITH_ETA.format(minutes=math.ceil(drain_seconds / 60))
+
     async def __error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger__.error("Exception while handling an update:", exc_info=context.error)
 
@@ -0,0 +1,113 @@
+import sqlite3
+
+from pathlib import Path
+from threading import Lock
+from time import time as getTime
+
+from modules.metrics import CACHE_LOOKUPS
+from settings import DISK_CACHE_MAINTENANCE_WRITES
+
+
+class DiskCache:
+    """
+    A small persistent key-value cache on top of SQLite.
+
+    Keeps at most `max_entries` values, evicting the least recently used ones,
+    and optionally forgets values older than `ttl` seconds.
+    Lookups are counted in the metrics under the given cache `name`.
+
+    Expired values are never returned, but they are only deleted, and the excess values evicted,
+    once every `DISK_CACHE_MAINTENANCE_WRITES` puts. The lookups are recorded in memory until then,
+    so a hit does not write to the disk.
+    """
+
+    def __init__(self, name: str, path: Path, max_entries: int, ttl: float | None = None) -> None:
+        self.__name = name
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__lock = Lock()
+        # Last lookup time of the keys hit since the last maintenance
+        self.__accessed: dict[str, float] = {}
+        self.__writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.__connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=30)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+        )
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at)"
+        )
+        self.__connection.commit()
+
+    def get(self, key: str) -> str | None:
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key: str) -> tuple[str, float] | None:
+        """The value with the time it was put, so a copy of it can expire along with it"""
+        now = getTime()
+
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or (self.__ttl is not None and now - row[1] > self.__ttl):
+                self.misses += 1
+                CACHE_LOOKUPS.labels(self.__name, "miss").inc()
+                return None
+
+            self.__accessed[key] = now
+
+            self.hits += 1
+            CACHE_LOOKUPS.labels(self.__name, "hit").inc()
+            return row[0], row[1]
+
+    def put(self, key: str, value: str) -> None:
+        now = getTime()
+
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self.__accessed.pop(key, None)
+
+            self.__writes += 1
+            if self.__writes >= DISK_CACHE_MAINTENANCE_WRITES:
+                self.__writes = 0
+                self.__maintain(now)
+
+            self.__connection.commit()
+
+    def __maintain(self, now: float) -> None:
+        """Records the lookups, then deletes the expired entries and evicts the excess ones"""
+        self.__connection.executemany(
+            "UPDATE entries SET accessed_at = ? WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in self.__accessed.items()],
+        )
+        self.__accessed.clear()
+
+        if self.__ttl is not None:
+            self.__connection.execute(
+                "DELETE FROM entries WHERE created_at < ?", (now - self.__ttl,)
+            )
+
+        # Evict the least recently used entries above the limit
+        self.__connection.execute(
+            "DELETE FROM entries WHERE key IN "
+            "(SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.__max_entries,),
+        )
@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import requests
+
+from pathlib import Path
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import time as getTime
+from traceback import format_exc
+
+from requests_toolbelt import MultipartEncoder
+
+from modules.log import LogPayload
+from modules.singleton_meta import SingletonMeta
+from modules.ais.audio_preprocessor import archive_path_for
+from modules.metrics import STAGE_DURATION, ERRORS
+from keys import ODOO_API_KEY
+from settings import (
+    LOGGER_NAME,
+    ODOO_UPLOAD_ENDPOINT,
+    UPLOAD_REVIEWS,
+    UPLOAD_OUTBOX_PATH,
+    UPLOAD_RETRY_BASE_DELAY,
+    UPLOAD_RETRY_MAX_DELAY,
+    UPLOAD_MAX_ATTEMPTS,
+    UPLOAD_TIMEOUT,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class UploadOutbox(metaclass=SingletonMeta):
+    """
+    A durable queue of reviews waiting to be uploaded to Odoo.
+
+    Reviews are stored in SQLite as soon as they are analysed, and a background sender
+    uploads them over a persistent HTTP session, retrying failed uploads with an exponential
+    backoff. Reviews which were not uploaded before a restart are sent after it.
+    """
+
+    def __init__(self, path: Path = UPLOAD_OUTBOX_PATH) -> None:
+        self.__lock = Lock()
+        self.__wakeup = Event()
+        self.__sender: Thread | None = None
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.__connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=30)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "audio_path TEXT, data TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, "
+            "created_at REAL NOT NULL, state TEXT NOT NULL DEFAULT 'pending', last_error TEXT)"
+        )
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS uploads_pending ON uploads (state, next_attempt_at)"
+        )
+        self.__connection.commit()
+
+    def enqueue(self, audio_path: Path | None, data: dict[str, str]) -> None:
+        now = getTime()
+
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT INTO uploads (audio_path, data, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    audio_path.absolute().as_posix() if audio_path is not None else None,
+                    json.dumps(data),
+                    now,
+                    now,
+                ),
+            )
+            self.__connection.commit()
+
+        self.__wakeup.set()
+
+    def pending_count(self) -> int:
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT COUNT(*) FROM uploads WHERE state = 'pending'"
+            ).fetchone()[0]
+
+    def pending_audio_paths(self) -> set[str]:
+        """Returns the recordings the pending uploads still need"""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT audio_path FROM uploads WHERE state = 'pending' AND audio_path IS NOT NULL"
+            ).fetchall()
+
+        return {audio_path for (audio_path,) in rows}
+
+    def start_sender(self) -> None:
+        """Starts uploading the queued reviews in a background thread"""
+        if self.__sender is not None:
+            return
+
+        self.__sender = Thread(target=self.__run_sender, name="upload-sender", daemon=True)
+        self.__sender.start()
+
+    def __run_sender(self) -> None:
+        # Reuse the connection to the endpoint between uploads
+        session = requests.Session()
+        session.headers.update({"API-Key": ODOO_API_KEY})
+
+        logger.info("Upload sender has been started with %d pending uploads", self.pending_count())
+
+        while True:
+            self.__wakeup.clear()
+            upload = self.__next_due()
+
+            if upload is None:
+                self.__wakeup.wait(timeout=self.__seconds_until_next())
+                continue
+
+            (upload_id, audio_path, data, attempts) = upload
+
+            try:
+                with STAGE_DURATION.labels("upload").time():
+                    error = self.__send(session, audio_path, json.loads(data))
+            except Exception as ex:
+                error = f"{ex} {ex.args}"
+                logger.error(f"Exception catched durint review upload: {error}\n{format_exc()}")
+
+            self.__finish(upload_id, attempts + 1, error)
+
+    def __send(
+        self, session: requests.Session, audio_path: str | None, data: dict[str, str]
+    ) -> str | None:
+        """Returns `None` if the review has been uploaded, or the error otherwise"""
+        upload_path = self.__resolve_audio(audio_path)
+
+        logger.debug(
+            "Uploading to %s:\n%s\n---\nWith file: %s",
+            ODOO_UPLOAD_ENDPOINT,
+            LogPayload(data),
+            upload_path,
+        )
+
+        if not UPLOAD_REVIEWS:
+            return None
+
+        fields: dict = dict(data)
+
+        if upload_path is None:
+            response = session.post(ODOO_UPLOAD_ENDPOINT, data=fields, timeout=UPLOAD_TIMEOUT)
+        else:
+            with open(upload_path, "rb") as audio_file:
+                # The file is streamed from disk instead of being read into the request body
+                fields["file"] = (upload_path.name, audio_file, "application/octet-stream")
+                body = MultipartEncoder(fields=fields)
+
+                response = session.post(
+                    ODOO_UPLOAD_ENDPOINT,
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    timeout=UPLOAD_TIMEOUT,
+                )
+
+        if response.status_code == 200:
+            logger.info("A review has been successfuly uploaded to the remote enpoint")
+            return None
+
+        return f"{response.status_code} | Text:\n{response.text}"
+
+    def __resolve_audio(self, audio_path: str | None) -> Path | None:
+        if audio_path is None:
+            return None
+
+        # Prefer the smaller archival .ogg file if it has already been made
+        archive_path = archive_path_for(Path(audio_path))
+        if archive_path.exists():
+            return archive_path
+
+        if Path(audio_path).exists():
+            return Path(audio_path)
+
+        logger.warning(
+            "Audio file %s no longer exists. Uploading the review without it.", audio_path
+        )
+        return None
+
+    def __next_due(self) -> tuple[int, str | None, str, int] | None:
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT id, audio_path, data, attempts FROM uploads "
+                "WHERE state = 'pending' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT 1",
+                (getTime(),),
+            ).fetchone()
+
+    def __seconds_until_next(self) -> float | None:
+        with self.__lock:
+            next_attempt_at = self.__connection.execute(
+                "SELECT MIN(next_attempt_at) FROM uploads WHERE state = 'pending'"
+            ).fetchone()[0]
+
+        if next_attempt_at is None:
+            return None
+
+        return max(next_attempt_at - getTime(), 0)
+
+    def __finish(self, upload_id: int, attempts: int, error: str | None) -> None:
+        if error is not None:
+            ERRORS.labels("upload").inc()
+
+        if error is None:
+            state, next_attempt_at = "done", getTime()
+        elif attempts >= UPLOAD_MAX_ATTEMPTS:
+            logger.error(f"A review upload has failed {attempts} times, giving up: {error}")
+            state, next_attempt_at = "failed", getTime()
+        else:
+            delay = min(UPLOAD_RETRY_BASE_DELAY * 2 ** (attempts - 1), UPLOAD_RETRY_MAX_DELAY)
+            logger.error(f"A review upload has failed, retrying in {delay} seconds: {error}")
+            state, next_attempt_at = "pending", getTime() + delay
+
+        with self.__lock:
+            self.__connection.execute(
+                "UPDATE uploads SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ? "
+                "WHERE id = ?",
+                (state, attempts, next_attempt_at, error, upload_id),
+            )
+            self.__connection.commit()
@@ -1,12 +1,13 @@
 import json
-import requests
 
 from pathlib import Path
 from logging import getLogger
+from traceback import format_exc
 
+from modules.log import LogPayload
 from modules.models.issue import Issue
-from keys import ODOO_API_KEY
-from settings import ODOO_UPLOAD_ENDPOINT, LOGGER_NAME
+from modules.endpoints.upload_outbox import UploadOutbox
+from settings import LOGGER_NAME
 
 
 logger = getLogger(LOGGER_NAME)
@@ -15,11 +16,12 @@ logger = getLogger(LOGGER_NAME)
 def upload_review(
     audio_review_path: Path | None, text_review: str, text_summary: str, issues: list[Issue]
 ) -> bool:
-    # Define the headers (use your access token for authorization)
-    headers = {
-        "API-Key": ODOO_API_KEY,
-    }
+    """
+    Queues the review for uploading to the remote endpoint.
 
+    Returns `True` once the review is safely stored in the outbox,
+    the upload itself is done by the outbox sender in the background
+    """
     # Prepare the data payload
     data = {
         "file_name": audio_review_path.stem if audio_review_path is not None else "",
@@ -28,30 +30,13 @@ def upload_review(
         "issues": json.dumps([issue.to_dict() for issue in issues]),
     }
 
-    # Prepare the files payload
-    files = (
-        {
-            "file": open(
-                audio_review_path.absolute().as_posix(), "rb"
-            ),  # Open the file in binary mode
-        }
-        if audio_review_path is not None
-        else None
-    )
+    try:
+        UploadOutbox().enqueue(audio_review_path, data)
+    except Exception as ex:
+        logger.error(f"Exception catched durint review queueing: {ex} {ex.args}\n{format_exc()}")
+        return False
 
     logger.debug(
-        f"Uploading to {ODOO_UPLOAD_ENDPOINT}:\n{data}\n---\nWith file: {audio_review_path}"
+        "Review queued for uploading:\n%s\n---\nWith file: %s", LogPayload(data), audio_review_path
     )
     return True
-
-    # # Send the POST request
-    # response = requests.post(ODOO_UPLOAD_ENDPOINT, headers=headers, data=data, files=files)
-
-    # if response.status_code == 200:
-    #     logger.info("A review has been successfuly uploaded to the remote enpoint")
-    #     return True
-    # else:
-    #     logger.error(
-    #         f"A review upload has failed: {response.status_code} | Text:\n{response.text}"
-    #     )
-    #     return False
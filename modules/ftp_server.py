@@ -1,21 +1,49 @@
+import os
+
+from io import BytesIO
 from pathlib import Path
 from logging import getLogger
 from traceback import format_exc
+from typing import Callable, BinaryIO
+from concurrent.futures import ThreadPoolExecutor
 
-from twisted.cred.checkers import FilePasswordDB
+from zope.interface import implementer
+from twisted.cred.checkers import FilePasswordDB, ANONYMOUS
 from twisted.cred.portal import Portal
 from twisted.internet import reactor
 
-from twisted.protocols.ftp import FTPFactory, FTPRealm, FTP
+from twisted.protocols.ftp import (
+    FTPFactory,
+    FTPRealm,
+    FTPShell,
+    FTP,
+    FTPCmdError,
+    FileConsumer,
+    IFTPShell,
+    IWriteFile,
+    InvalidPath,
+    REQ_ACTN_ABRTD_FILE_UNAVAIL,
+    toSegments,
+)
 
 # from twisted.protocols.ftp import FTPRealm, FTP
 from twisted.cred import credentials, error
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 from modules.reviewing.review_context import ReviewQueues
+from modules.reviewing.review_replies import ReplyListener
 from modules.reviewing.device_strategy import DeviceStrategy
+from modules.reviewing.admission_control import AdmissionControl
+from modules.metrics import JOBS_REFUSED
+from modules.ais.audio_preprocessor import persist_recording
 
-from settings import RECORDINGS_FOLDER, ALLOWED_EXTENSIONS, LOGGER_NAME
+from settings import (
+    RECORDINGS_FOLDER,
+    ALLOWED_EXTENSIONS,
+    LOGGER_NAME,
+    FTP_MEMORY_INGEST,
+    FTP_MEMORY_INGEST_LIMIT,
+)
 
 
 logger = getLogger(LOGGER_NAME)
@@ -66,43 +94,260 @@ class CustomDB(FilePasswordDB):
                 )
 
 
+def should_transcribe_file(file_path: Path) -> bool:
+    if file_path.parent.name != RECORDINGS_FOLDER:
+        return False
+
+    if file_path.suffix not in ALLOWED_EXTENSIONS:
+        return False
+
+    return True
+
+
+class ReviewerBusyError(FTPCmdError):
+    """
+    Refuses an upload while the reviewer is overloaded.
+    A 450 reply is a transient error, the device keeps the recording and retries later.
+    """
+
+    errorCode = REQ_ACTN_ABRTD_FILE_UNAVAIL
+
+
+class RecordingBuffer:
+    """
+    A write-only file which keeps the uploaded recording in memory,
+    and moves it into a file next to `audio_path` once it grows above `limit` bytes.
+    """
+
+    def __init__(self, audio_path: Path, limit: int = FTP_MEMORY_INGEST_LIMIT) -> None:
+        self.audio_path = audio_path
+        self.__limit = limit
+        self.__memory: BytesIO | None = BytesIO()
+        self.__spill: BinaryIO | None = None
+
+    @property
+    def spilled(self) -> bool:
+        return self.__spill is not None
+
+    def write(self, data: bytes) -> None:
+        if self.__memory is not None and self.__memory.tell() + len(data) > self.__limit:
+            logger.debug(
+                "Recording %s is too large for the memory, writing it to the disk...",
+                self.audio_path,
+            )
+            self.__spill = open(self.__part_path(), "wb")
+            self.__spill.write(self.__memory.getbuffer())
+            self.__memory = None
+
+        if self.__spill is not None:
+            self.__spill.write(data)
+        elif self.__memory is not None:
+            self.__memory.write(data)
+
+    def close(self) -> None:
+        """Called by the consumer at the end of the transfer, whether it has succeeded or not"""
+        if self.__spill is not None and not self.__spill.closed:
+            self.__spill.close()
+
+    def complete(self) -> None:
+        """Moves the spilled file into place, once the transfer has succeeded"""
+        self.close()
+
+        if self.__spill is not None:
+            self.__part_path().replace(self.audio_path)
+
+    def discard(self) -> None:
+        """Drops the recording of a transfer which has failed, with its spilled file"""
+        self.close()
+
+        if self.__spill is not None:
+            self.__part_path().unlink(missing_ok=True)
+
+        self.__memory = None
+
+    def getvalue(self) -> bytes:
+        return self.__memory.getvalue() if self.__memory is not None else b""
+
+    def __part_path(self) -> Path:
+        return self.audio_path.with_name(f"{self.audio_path.name}.part")
+
+
+@implementer(IWriteFile)
+class RecordingWriter:
+    """Receives an uploaded recording into a `RecordingBuffer`, and hands it over once complete"""
+
+    def __init__(
+        self, buffer: RecordingBuffer, on_received: Callable[[RecordingBuffer], None]
+    ) -> None:
+        self.__buffer = buffer
+        self.__on_received = on_received
+        # Closed after a successful transfer, or discarded after a failed one
+        self.finished = False
+
+    def receive(self):
+        return defer.succeed(FileConsumer(self.__buffer))
+
+    def close(self):
+        """Only called once the transfer has succeeded"""
+        if self.finished:
+            return defer.succeed(None)
+
+        self.finished = True
+
+        try:
+            self.__buffer.complete()
+        except Exception as ex:
+            logger.error(
+                f"Exception catched durint recording ingest: {ex} {ex.args}\n{format_exc()}"
+            )
+            return defer.succeed(None)
+
+        # Queueing the recording reads and writes the job journal, so it is done off the reactor
+        received = threads.deferToThread(self.__on_received, self.__buffer)
+        received.addErrback(
+            lambda failure: logger.error(
+                f"Exception catched durint recording ingest: {failure.value}\n"
+                f"{failure.getTraceback()}"
+            )
+        )
+
+        return received
+
+    def discard(self) -> None:
+        if self.finished:
+            return
+
+        self.finished = True
+        logger.warning(
+            "Upload of recording %s has not been completed, discarding it", self.__buffer.audio_path
+        )
+        self.__buffer.discard()
+
+
+class RecordingFtpShell(FTPShell):
+    """An FTP shell which receives the recordings into memory instead of writing them to the disk"""
+
+    def __init__(self, filesystemRoot, on_received: Callable[[RecordingBuffer], None]) -> None:
+        super().__init__(filesystemRoot)
+        self.__on_received = on_received
+        self.__writers: list[RecordingWriter] = []
+
+    def openForWriting(self, path):
+        audio_path = Path(os.fsdecode(self._path(path).path))
+
+        if not should_transcribe_file(audio_path):
+            return super().openForWriting(path)
+
+        writer = RecordingWriter(RecordingBuffer(audio_path), self.__on_received)
+        self.__writers.append(writer)
+
+        return defer.succeed(writer)
+
+    def discard_unfinished(self) -> None:
+        """Drops the recordings whose transfer has ended or been cut off without being closed"""
+        for writer in self.__writers:
+            writer.discard()
+
+        self.__writers.clear()
+
+
+class RecordingFtpRealm(FTPRealm):
+    def __init__(
+        self, anonymousRoot, userHome, on_received: Callable[[RecordingBuffer], None]
+    ) -> None:
+        super().__init__(anonymousRoot, userHome)
+        self.__on_received = on_received
+
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        if avatarId is ANONYMOUS or IFTPShell not in interfaces:
+            return super().requestAvatar(avatarId, mind, *interfaces)
+
+        avatar = RecordingFtpShell(self.getHomeDirectory(avatarId), self.__on_received)
+        return (IFTPShell, avatar, lambda: None)
+
+
 class CustomFtpProtocol(FTP):
     def __init__(self, review_queues: ReviewQueues) -> None:
         super().__init__()
         self.__review_queues = review_queues
 
     def ftp_STOR(self, path):
+        try:
+            # Relative to the working directory of the session, as the shell resolves it
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            # Refused by the shell with the right reply
+            return super(CustomFtpProtocol, self).ftp_STOR(path)
+
+        if not self.should_transcribe_file(Path("/", *segments)):
+            return self.__store(path, segments)
+
+        # Refused before the transfer,
+        # so an overloaded reviewer does not take the recording in at all.
+        # The backlog is read from SQLite, so it is done off the reactor
+        admitted = threads.deferToThread(AdmissionControl().admit_device_recording)
+        admitted.addCallback(self.__store_if_admitted, path, segments)
+
+        return admitted
+
+    def __store_if_admitted(self, admitted: bool, path, segments: list[str]):
+        if not admitted:
+            JOBS_REFUSED.labels(DeviceStrategy.SOURCE).inc()
+            raise ReviewerBusyError()
+
+        return self.__store(path, segments)
+
+    def __store(self, path, segments: list[str]):
         deff = super(CustomFtpProtocol, self).ftp_STOR(path)
 
         def onStorComplete(deff):
             try:
-                audio_path: Path = Path(self.shell.filesystemRoot.path.decode()) / path
+                audio_path = Path(self.shell.filesystemRoot.path.decode(), *segments)
 
-                if not self.should_transcribe_file(audio_path):
+                # Recordings received into memory have already been queued by the shell
+                if FTP_MEMORY_INGEST or not self.should_transcribe_file(audio_path):
                     return deff
 
-                self.__review_queues.audio_queue.put((DeviceStrategy(), audio_path))
-
+                # The job journal is written to, so it is done off the reactor
+                queued = threads.deferToThread(
+                    self.__review_queues.put_audio, DeviceStrategy.SOURCE, audio_path
+                )
             except Exception as ex:
                 logger.error(
                     f"Exception catched durint audio transcription: {ex} {ex.args}\n{format_exc()}"
                 )
                 return None
 
-            return deff
+            def onQueueFailed(failure):
+                logger.error(
+                    f"Exception catched durint audio transcription: {failure.value}\n"
+                    f"{failure.getTraceback()}"
+                )
+
+            return queued.addCallbacks(lambda _: deff, onQueueFailed)
 
         deff.addCallback(onStorComplete)
+        # A transfer which has failed does not close its file, which is then left behind
+        deff.addBoth(self.__discard_unfinished)
 
         return deff
 
-    def should_transcribe_file(self, file_path: Path) -> bool:
-        if file_path.parent.name != RECORDINGS_FOLDER:
-            return False
+    def connectionLost(self, reason):
+        shell = self.shell
+        super().connectionLost(reason)
 
-        if file_path.suffix not in ALLOWED_EXTENSIONS:
-            return False
+        # An upload cut off with the connection never finishes its STOR
+        if isinstance(shell, RecordingFtpShell):
+            shell.discard_unfinished()
 
-        return True
+    def __discard_unfinished(self, result):
+        if isinstance(self.shell, RecordingFtpShell):
+            self.shell.discard_unfinished()
+
+        return result
+
+    def should_transcribe_file(self, file_path: Path) -> bool:
+        return should_transcribe_file(file_path)
 
 
 class CustomFtpFactory(FTPFactory):
@@ -128,16 +373,58 @@ class FtpServer:
     def __init__(self, review_queues: ReviewQueues) -> None:
         self.__review_queues = review_queues
 
-        portal = Portal(
-            FTPRealm(anonymousRoot="./", userHome="./home"), [CustomDB("static/pass.dat")]
-        )
+        if FTP_MEMORY_INGEST:
+            realm = RecordingFtpRealm(
+                anonymousRoot="./", userHome="./home", on_received=self.__on_recording_received
+            )
+            # The raw recordings are written to the disk one at a time, off the reactor thread
+            self.__persister = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="recording-persister"
+            )
+        else:
+            realm = FTPRealm(anonymousRoot="./", userHome="./home")
+
+        portal = Portal(realm, [CustomDB("static/pass.dat")])
 
         self.__factory = CustomFtpFactory(self.__review_queues, portal=portal)
         # f.protocol = CustomFtpProtocol
         self.__factory.passivePortRange = range(45_000, 45_010)
 
     def run_ftp_server(self):
+        # Devices can not be replied to, the outcomes of their reviews are only logged
+        ReplyListener(
+            self.__review_queues.reply_queues[DeviceStrategy.SOURCE], lambda reply: DeviceStrategy()
+        ).start()
+
         logger.info("FTP server has been started on port 20021")
 
         reactor.listenTCP(20021, self.__factory)
         reactor.run()
+
+    def __on_recording_received(self, buffer: RecordingBuffer) -> None:
+        if buffer.spilled:
+            # Too large to be sent between the processes, the reviewer reads the file instead
+            self.__review_queues.put_audio(DeviceStrategy.SOURCE, buffer.audio_path)
+            return
+
+        data = buffer.getvalue()
+
+        if not AdmissionControl().hold_in_memory():
+            # The recordings wait in the queues for long under a backlog,
+            # so only their paths are held
+            logger.info(
+                "Recording %s of %d bytes received, writing it before queueing",
+                buffer.audio_path,
+                len(data),
+            )
+            self.__persister.submit(self.__persist_and_queue, buffer.audio_path, data)
+            return
+
+        logger.info("Recording %s of %d bytes received into memory", buffer.audio_path, len(data))
+
+        self.__review_queues.put_audio(DeviceStrategy.SOURCE, buffer.audio_path, audio=data)
+        self.__persister.submit(persist_recording, buffer.audio_path, data)
+
+    def __persist_and_queue(self, audio_path: Path, data: bytes) -> None:
+        if persist_recording(audio_path, data, check_archive=False):
+            self.__review_queues.put_audio(DeviceStrategy.SOURCE, audio_path)
@@ -1,28 +1,170 @@
+import copy
+import json
+import random
+import signal
 import logging
 
-from concurrent_log_handler import ConcurrentTimedRotatingFileHandler
+from datetime import datetime
+from logging.handlers import QueueHandler, TimedRotatingFileHandler
+from multiprocessing import Process, Queue
+from multiprocessing.queues import Queue as ProcessQueue
 
-from settings import LOG_LEVEL, LOG_FORMAT
+from settings import (
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_FILE,
+    LOG_JSON,
+    LOG_PAYLOAD_MAX_CHARS,
+    LOG_PAYLOAD_SAMPLE_RATE,
+)
 
 
-def setup_custom_logger(name):
-    formatter = logging.Formatter(fmt=LOG_FORMAT)
+# The queue the records of this process are sent to, set by `setup_custom_logger()`
+_log_queue: ProcessQueue | None = None
+# The logging process, only known to the main process
+_listener: Process | None = None
+# Formats the tracebacks before the records are sent, they cannot be pickled
+_exception_formatter = logging.Formatter()
 
-    # file_handler = logging.FileHandler(LOG_FILE)
-    # file_handler = CustomTimedRotatingFileHandler("logs/eld-log.log", when="midnight", delay=True)
-    # file_handler = CustomTimedRotatingFileHandler("logs/eld-log.log", when="S", interval=10, delay=True)
-    # file_handler = ConcurrentTimedRotatingFileHandler("logs/eld-log.log", when="S", interval=10, delay=True)
-    file_handler = ConcurrentTimedRotatingFileHandler(
-        "logs/transcriber.log", when="midnight", delay=True
-    )
-    file_handler.setFormatter(formatter)
+
+class JsonFormatter(logging.Formatter):
+    """Formats every record as a single line JSON object"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "process": record.processName,
+            "thread": record.threadName,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+
+        # Formatted by `RecordQueueHandler`, as the traceback itself does not cross the queue
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Sends the records to the logging process with the traceback of their exception in `exc_text`,
+    rather than appended to the message as by `QueueHandler`, so the formatters can place it
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = record.exc_text or _exception_formatter.formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+
+        return record
+
+
+class LogPayload:
+    """
+    A large text to be logged, e.g. a prompt. It is only cut to `LOG_PAYLOAD_MAX_CHARS`
+    when the record is formatted, so it costs nothing if the record is not logged.
+
+    Pass it as an argument, not in an f-string:
+    `logger.debug("Prompting:\\n%s", LogPayload(prompt))`
+    """
+
+    def __init__(self, text: object) -> None:
+        self.__text = text
+
+    def __str__(self) -> str:
+        text = str(self.__text)
+
+        if LOG_PAYLOAD_MAX_CHARS is None or len(text) <= LOG_PAYLOAD_MAX_CHARS:
+            return text
+
+        omitted = len(text) - LOG_PAYLOAD_MAX_CHARS
+        return f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({omitted} more characters)"
+
+
+def sample_payload(logger: logging.Logger) -> bool:
+    """Whether the payloads of a single exchange, e.g. a prompt and its response, are logged"""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def start_log_listener() -> ProcessQueue:
+    """
+    Starts the process which writes the records of all the other processes,
+    and returns the queue they are sent to. Has to be called before the other processes are started.
+    """
+    global _listener
+    log_queue: ProcessQueue = Queue()
+
+    _listener = Process(target=run_log_listener, args=(log_queue,), name="Logging", daemon=True)
+    _listener.start()
+
+    return log_queue
+
+
+def stop_log_listener(timeout: float = 10) -> None:
+    """Lets the logging process write the remaining records and stop"""
+    if _listener is None or _log_queue is None:
+        return
+
+    _log_queue.put(None)
+    _listener.join(timeout)
+
+
+def run_log_listener(log_queue: ProcessQueue) -> None:
+    # Stopped by `stop_log_listener()`,
+    # so the records sent while the others shut down are still written
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    file_handler = TimedRotatingFileHandler(LOG_FILE, when="midnight", delay=True, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(fmt=LOG_FORMAT))
 
     stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
+    stream_handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+
+    while True:
+        try:
+            record: logging.LogRecord | None = log_queue.get()
+        except (EOFError, OSError):
+            break
+
+        if record is None:
+            break
+
+        file_handler.handle(record)
+        stream_handler.handle(record)
+
+    file_handler.close()
+
+
+def setup_custom_logger(name, log_queue: ProcessQueue | None = None):
+    """
+    Sends the records of the logger to the logging process through `log_queue`,
+    or the queue of this process if it is not given.
+
+    Sending a record only puts it into a pipe, so logging does not hold the caller up.
+    """
+    global _log_queue
+    _log_queue = log_queue if log_queue is not None else _log_queue
+
+    if _log_queue is None:
+        raise RuntimeError("The logging process has not been started")
 
     logger = logging.getLogger(name)
     logger.setLevel(LOG_LEVEL)
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    # The handlers inherited from the parent process are replaced, not added to
+    logger.handlers = [RecordQueueHandler(_log_queue)]
+    logger.propagate = False
 
     return logger
+
+
+def current_log_queue() -> ProcessQueue | None:
+    """The queue the records of this process are sent to, to be passed to the spawned processes"""
+    return _log_queue
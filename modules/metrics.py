@@ -0,0 +1,97 @@
+import os
+import shutil
+
+from time import time as getTime
+
+from settings import METRICS_DIR, METRICS_ADDRESS, METRICS_PORT
+
+# Every process writes its samples into files of this directory, so the metrics
+# of all the processes are served together. Has to be set before prometheus_client is imported.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", METRICS_DIR.absolute().as_posix())
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess, start_http_server  # noqa: E402
+from prometheus_client.core import GaugeMetricFamily  # noqa: E402
+
+
+STAGE_DURATION = Histogram(
+    "review_stage_duration_seconds",
+    "Duration of the review pipeline stages",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+JOB_WAIT = Histogram(
+    "review_job_wait_seconds",
+    "Time review jobs spent in the queue before being started",
+    ["kind", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600),
+)
+JOBS_ENQUEUED = Counter("review_jobs_enqueued_total", "Review jobs queued", ["kind", "source"])
+JOBS_REFUSED = Counter(
+    "review_jobs_refused_total", "Reviews refused by the admission control", ["source"]
+)
+ERRORS = Counter("review_errors_total", "Errors in the review pipeline", ["stage"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups", ["cache", "result"])
+
+
+class BacklogCollector:
+    """Reports the review backlog at scrape time, from the queues and the job journal"""
+
+    def __init__(self, review_queues) -> None:
+        self.__review_queues = review_queues
+
+    def collect(self):
+        # Imported here, so the metrics module does not depend on the reviewing package
+        from modules.reviewing.job_journal import JobJournal
+        from modules.endpoints.upload_outbox import UploadOutbox
+
+        journal = JobJournal()
+        unfinished_counts = journal.unfinished_counts()
+
+        depth = GaugeMetricFamily(
+            "review_queue_depth", "Review jobs waiting in the queues", labels=["kind"]
+        )
+        for kind, queue in (
+            ("audio", self.__review_queues.audio_queue),
+            ("text", self.__review_queues.text_queue),
+        ):
+            try:
+                depth.add_metric([kind], queue.qsize())
+            except NotImplementedError:
+                # qsize() is not available on every platform, the journal knows it too
+                depth.add_metric([kind], unfinished_counts.get((kind, "queued"), 0))
+        yield depth
+
+        jobs = GaugeMetricFamily(
+            "review_jobs", "Unfinished review jobs by their state", labels=["kind", "state"]
+        )
+        for (kind, state), count in unfinished_counts.items():
+            jobs.add_metric([kind, state], count)
+        yield jobs
+
+        oldest = journal.oldest_unfinished()
+        yield GaugeMetricFamily(
+            "review_oldest_job_age_seconds",
+            "Age of the oldest unfinished review job",
+            value=getTime() - oldest if oldest is not None else 0,
+        )
+
+        yield GaugeMetricFamily(
+            "upload_outbox_pending",
+            "Reviews waiting to be uploaded",
+            value=UploadOutbox().pending_count(),
+        )
+
+
+def reset_metrics() -> None:
+    """Forgets the samples of the previous run, has to be called before the processes are started"""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def start_metrics_server(review_queues) -> None:
+    """Serves the metrics of all the processes in the Prometheus text format, in the background"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(BacklogCollector(review_queues))
+
+    start_http_server(METRICS_PORT, addr=METRICS_ADDRESS, registry=registry)
@@ -0,0 +1,97 @@
+from logging import getLogger
+from threading import Lock
+from time import time as getTime
+from typing import NamedTuple
+
+from .job_journal import JobJournal
+from modules.singleton_meta import SingletonMeta
+from settings import (
+    LOGGER_NAME,
+    ADMISSION_MAX_BACKLOG,
+    ADMISSION_MAX_DEVICE_DRAIN,
+    ADMISSION_MEMORY_BACKLOG,
+    ADMISSION_THROUGHPUT_WINDOW,
+    ADMISSION_DEFAULT_JOB_SECONDS,
+    ADMISSION_MIN_SAMPLES,
+    ADMISSION_REFRESH_SECONDS,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class Backlog(NamedTuple):
+    # unfinished jobs of all the sources
+    jobs: int
+    # estimated time (in seconds) until all of them are finished
+    drain_seconds: float
+
+
+class AdmissionControl(metaclass=SingletonMeta):
+    """
+    Decides whether the ingest processes take new reviews in, based on the backlog of the pipeline.
+
+    The backlog is read from the `JobJournal`, which is shared by all the processes, and its drain
+    time is estimated from how fast the jobs have been finished while the pipeline was busy.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__backlog: Backlog | None = None
+        self.__estimated_at = 0.0
+
+    def backlog(self) -> Backlog:
+        with self.__lock:
+            if (
+                self.__backlog is None
+                or getTime() - self.__estimated_at > ADMISSION_REFRESH_SECONDS
+            ):
+                self.__backlog = self.__estimate()
+                self.__estimated_at = getTime()
+
+            return self.__backlog
+
+    def admit_device_recording(self) -> bool:
+        """Whether a recording of a device is taken in now, otherwise the device retries later"""
+        backlog = self.backlog()
+        admitted = (
+            backlog.jobs < ADMISSION_MAX_BACKLOG
+            and backlog.drain_seconds < ADMISSION_MAX_DEVICE_DRAIN
+        )
+
+        if not admitted:
+            logger.warning(
+                "Refusing a device recording, %d jobs are waiting for about %.0f seconds",
+                backlog.jobs,
+                backlog.drain_seconds,
+            )
+
+        return admitted
+
+    def overloaded(self) -> bool:
+        """Whether the backlog is so large that the new reviews will only be processed much later"""
+        return self.backlog().jobs >= ADMISSION_MAX_BACKLOG
+
+    def hold_in_memory(self) -> bool:
+        """Whether the backlog is small enough to keep the recordings in memory while they wait"""
+        return self.backlog().jobs < ADMISSION_MEMORY_BACKLOG
+
+    def __estimate(self) -> Backlog:
+        journal = JobJournal()
+        now = getTime()
+
+        jobs = sum(journal.unfinished_counts().values())
+        if jobs == 0:
+            return Backlog(0, 0.0)
+
+        # The pipeline has been busy at least since the oldest unfinished job was queued,
+        # so the jobs finished since then show how fast it drains when it is loaded
+        busy_since = max(now - ADMISSION_THROUGHPUT_WINDOW, journal.oldest_unfinished() or now)
+        finished = journal.finished_since(busy_since)
+
+        if finished < ADMISSION_MIN_SAMPLES or now - busy_since <= 0:
+            seconds_per_job = ADMISSION_DEFAULT_JOB_SECONDS
+        else:
+            seconds_per_job = (now - busy_since) / finished
+
+        return Backlog(jobs, jobs * seconds_per_job)
@@ -6,14 +6,13 @@ import modules.bots.bot_replies as bot_replies
 
 from .review_strategy import ReviewStrategy
 from modules.models.issue import Issue
-from modules.ais.audio_transcriber import AudioTranscriber
-from modules.ais.review_analizer import ReviewAnalizer
-from modules.endpoints.upload_review import upload_review
 from settings import LOGGER_NAME
 
 
 logger = getLogger(LOGGER_NAME)
 
+TRANSCRIPTION_PROGRESS_LIMIT = 3_500
+
 
 class UserDialog(ABC):
     @abstractmethod
@@ -24,42 +23,49 @@ class UserDialog(ABC):
     def send_image(self, image_path: Path) -> None:
         pass
 
+    @abstractmethod
+    def show_progress(self, message: str) -> None:
+        """Sends the message the first time, and edits the same message afterwards"""
+        pass
+
 
 class BotReviewStrategy(ReviewStrategy):
+    SOURCE = "telegram"
+
     def __init__(self, bot_instance: UserDialog) -> None:
         self.__bot_instance = bot_instance
-        self.__audio_path: Path | None = None
+        self.__transcribed_parts: list[str] = []
+
+    def handle_progress(self, transcribed_part: str) -> None:
+        self.__transcribed_parts.append(transcribed_part)
+        transcribed = "".join(self.__transcribed_parts).strip(" \n")
 
-    def handle_audio(self, audio_path: Path) -> None:
-        self.__audio_path = audio_path
-        transcribed = AudioTranscriber().transcribe_audio(audio_path)
+        # Telegram messages are limited to 4096 characters, so only the latest text is shown
+        if len(transcribed) > TRANSCRIPTION_PROGRESS_LIMIT:
+            transcribed = "…" + transcribed[-TRANSCRIPTION_PROGRESS_LIMIT:]
 
-        if transcribed is None:
-            logger.warning("Transcription returned an empty value. Error?")
-            self.__bot_instance.send_message(bot_replies.TRANSCRIPTION_ERROR)
-            return
+        self.__bot_instance.show_progress(
+            f"{bot_replies.TRANSCRIPTION_IN_PROGRESS}\n\n{transcribed}"
+        )
 
-        self.handle_text(transcribed)
+    def handle_transcription_error(self) -> None:
+        logger.warning("Transcription returned an empty value. Error?")
+        self.__bot_instance.send_message(bot_replies.TRANSCRIPTION_ERROR)
 
-    def handle_text(self, text_message: str) -> None:
-        review = ReviewAnalizer().summarize_review(text_message)
-        
-        if review is None:
-            self.__bot_instance.send_message(bot_replies.TRANSCRIPTION_ERROR)
-            return
+    def handle_no_speech(self) -> None:
+        self.__bot_instance.send_message(bot_replies.NO_SPEECH)
 
-        self.__bot_instance.send_message(self.__issues_to_text(review.issues))
+    def handle_analysis_error(self) -> None:
+        self.__bot_instance.send_message(bot_replies.TRANSCRIPTION_ERROR)
 
-        if not upload_review(
-            audio_review_path=self.__audio_path,
-            text_review=review.corrected_text,
-            text_summary=review.summary,
-            issues=review.issues,
-        ):
-            self.__bot_instance.send_message(bot_replies.UPLOAD_ERROR)
+    def handle_review(self, issues: list[Issue]) -> None:
+        self.__bot_instance.send_message(self.__issues_to_text(issues))
 
         # QR CODE SHOULD BE SENT HERE
 
+    def handle_upload_error(self) -> None:
+        self.__bot_instance.send_message(bot_replies.UPLOAD_ERROR)
+
     def __issues_to_text(self, issues: list[Issue]) -> str:
         if len(issues) == 0:
             return bot_replies.TRANSCRIPTION_DONE_NO_ISSUES
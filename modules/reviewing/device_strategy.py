@@ -1,10 +1,7 @@
-from pathlib import Path
 from logging import getLogger
 
 from .review_strategy import ReviewStrategy
-from modules.ais.audio_transcriber import AudioTranscriber
-from modules.ais.review_analizer import ReviewAnalizer
-from modules.endpoints.upload_review import upload_review
+from modules.models.issue import Issue
 from settings import LOGGER_NAME
 
 
@@ -12,29 +9,26 @@ logger = getLogger(LOGGER_NAME)
 
 
 class DeviceStrategy(ReviewStrategy):
+    SOURCE = "device"
+
     def __init__(self) -> None:
         pass
 
-    def handle_audio(self, audio_path: Path) -> None:
-        self.__audio_path = audio_path
-        transcribed = AudioTranscriber().transcribe_audio(audio_path)
+    def handle_progress(self, transcribed_part: str) -> None:
+        pass
 
-        if transcribed is None:
-            logger.warning("Transcription returned an empty value. Error?")
-            return
+    def handle_transcription_error(self) -> None:
+        logger.warning("Transcription returned an empty value. Error?")
 
-        self.handle_text(transcribed)
+    def handle_no_speech(self) -> None:
+        logger.info("Recording does not contain speech. It has been skipped.")
 
-    def handle_text(self, text_message: str) -> None:
-        review = ReviewAnalizer().summarize_review(text_message)
+    def handle_analysis_error(self) -> None:
+        logger.warning("Review analizer returned an empty value. Error?")
 
-        if review is None:
-            logger.warning("Review analizer returned an empty value. Error?")
-            return
+    def handle_review(self, issues: list[Issue]) -> None:
+        # Devices have nobody to report the issues to
+        pass
 
-        upload_review(
-            audio_review_path=self.__audio_path,
-            text_review=review.corrected_text,
-            text_summary=review.summary,
-            issues=review.issues,
-        )
+    def handle_upload_error(self) -> None:
+        logger.warning("Review upload has failed.")
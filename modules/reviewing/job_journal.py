@@ -0,0 +1,172 @@
+import sqlite3
+
+from enum import Enum
+from pathlib import Path
+from logging import getLogger
+from threading import Lock
+from time import time as getTime
+
+from modules.singleton_meta import SingletonMeta
+from settings import LOGGER_NAME, JOB_JOURNAL_PATH, JOB_JOURNAL_RETENTION
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class JobState(Enum):
+    QUEUED = "queued"
+    TRANSCRIBING = "transcribing"
+    ANALYSING = "analysing"
+    UPLOADING = "uploading"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class JournalEntry:
+    def __init__(
+        self,
+        job_id: int,
+        kind: str,
+        source: str,
+        payload: str,
+        chat_id: int | None,
+        message_id: int | None,
+        state: JobState,
+    ) -> None:
+        self.job_id = job_id
+        self.kind = kind
+        self.source = source
+        self.payload = payload
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.state = state
+
+
+class JobJournal(metaclass=SingletonMeta):
+    """
+    A crash-safe record of every review job and the stage it has reached.
+
+    Backed by SQLite in WAL mode, so the ingest processes and the reviewing process
+    can write to it at the same time, and a job costs a single short transaction per state change.
+    Every process gets its own instance with its own connection.
+    """
+
+    def __init__(self, path: Path = JOB_JOURNAL_PATH) -> None:
+        self.__lock = Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.__connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=30)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        # WAL with NORMAL sync survives process crashes and costs no fsync per transaction
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, source TEXT NOT NULL, "
+            "payload TEXT NOT NULL, chat_id INTEGER, message_id INTEGER, state TEXT NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self.__connection.commit()
+
+    def add(
+        self,
+        kind: str,
+        source: str,
+        payload: str,
+        chat_id: int | None = None,
+        message_id: int | None = None,
+    ) -> int:
+        """Records a new queued job and returns its id"""
+        now = getTime()
+
+        with self.__lock:
+            cursor = self.__connection.execute(
+                "INSERT INTO jobs "
+                "(kind, source, payload, chat_id, message_id, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, source, payload, chat_id, message_id, JobState.QUEUED.value, now, now),
+            )
+            self.__connection.commit()
+
+        return int(cursor.lastrowid or 0)
+
+    def set_state(self, job_id: int, state: JobState) -> None:
+        with self.__lock:
+            self.__connection.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?",
+                (state.value, getTime(), job_id),
+            )
+            self.__connection.commit()
+
+    def state_of(self, job_id: int) -> JobState | None:
+        """Returns the state the job has reached, or `None` if it is not in the journal"""
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT state FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+
+        return JobState(row[0]) if row is not None else None
+
+    def unfinished(self, created_before: float) -> list[JournalEntry]:
+        """Returns the unfinished jobs created before the given time, oldest first"""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT id, kind, source, payload, chat_id, message_id, state FROM jobs "
+                "WHERE state NOT IN (?, ?) AND created_at < ? ORDER BY id",
+                (JobState.DONE.value, JobState.FAILED.value, created_before),
+            ).fetchall()
+
+        return [
+            JournalEntry(job_id, kind, source, payload, chat_id, message_id, JobState(state))
+            for (job_id, kind, source, payload, chat_id, message_id, state) in rows
+        ]
+
+    def unfinished_payloads(self, kind: str) -> set[str]:
+        """Returns the payloads of the unfinished jobs of the given kind"""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT payload FROM jobs WHERE kind = ? AND state NOT IN (?, ?)",
+                (kind, JobState.DONE.value, JobState.FAILED.value),
+            ).fetchall()
+
+        return {payload for (payload,) in rows}
+
+    def unfinished_counts(self) -> dict[tuple[str, str], int]:
+        """Returns the number of unfinished jobs by their (kind, state)"""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT kind, state, COUNT(*) FROM jobs WHERE state NOT IN (?, ?) "
+                "GROUP BY kind, state",
+                (JobState.DONE.value, JobState.FAILED.value),
+            ).fetchall()
+
+        return {(kind, state): count for (kind, state, count) in rows}
+
+    def oldest_unfinished(self) -> float | None:
+        """Returns the creation time of the oldest unfinished job, or `None` if there are none"""
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE state NOT IN (?, ?)",
+                (JobState.DONE.value, JobState.FAILED.value),
+            ).fetchone()
+
+        return row[0] if row is not None else None
+
+    def finished_since(self, since: float) -> int:
+        """Returns the number of jobs finished after the given time"""
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state IN (?, ?) AND updated_at >= ?",
+                (JobState.DONE.value, JobState.FAILED.value, since),
+            ).fetchone()[0]
+
+    def prune(self, retention: float = JOB_JOURNAL_RETENTION) -> None:
+        """Forgets the finished jobs older than `retention` seconds"""
+        with self.__lock:
+            cursor = self.__connection.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?",
+                (JobState.DONE.value, JobState.FAILED.value, getTime() - retention),
+            )
+            self.__connection.commit()
+
+        logger.debug("Pruned %s finished jobs from the journal", cursor.rowcount)
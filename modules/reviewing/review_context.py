@@ -1,40 +1,429 @@
-from time import sleep
 from logging import getLogger
-from pathlib import Path, PurePath
+from pathlib import Path
+
 # from multiprocessing import Queue
-from queue import Queue
-from threading import Thread
+from itertools import count
+from queue import PriorityQueue, Queue
+from threading import Lock, Thread
+from time import time as getTime
+from traceback import format_exc
 
-from .review_strategy import ReviewStrategy
+from .review_job import JobKind, JobPriority, ReplyOutcome, ReviewJob, ReviewReply
+from .review_dispatcher import ReviewDispatcher
+from .job_journal import JobJournal, JobState
+from modules.models.issue import Issue
+from modules.ais.audio_preprocessor import BufferedAudio, audio_duration
 from modules.ais.audio_transcriber import AudioTranscriber
+from modules.ais.transcription_pool import TranscriptionPool
 from modules.ais.review_analizer import ReviewAnalizer
-from settings import LOGGER_NAME
+from modules.endpoints.upload_outbox import UploadOutbox
+from modules.endpoints.upload_review import upload_review
+from modules.metrics import JOB_WAIT, JOBS_ENQUEUED, ERRORS
+from settings import (
+    LOGGER_NAME,
+    TRANSCRIPTION_BATCH_SIZE,
+    TRANSCRIPTION_BATCH_MAX_WAIT,
+    TRANSCRIPTION_WORKERS,
+    TRANSCRIPTION_PROCESSES,
+    ANALYSIS_WORKERS,
+    ANALYSIS_QUEUE_SIZE,
+    WHISPER_TRANSLATION,
+)
 
 
 logger = getLogger(LOGGER_NAME)
 
 
 class ReviewQueues:
-    audio_queue: Queue[tuple[ReviewStrategy, Path]] = Queue()
-    text_queue: Queue[tuple[ReviewStrategy, str]] = Queue()
+    audio_queue: Queue[ReviewJob] = Queue()
+    text_queue: Queue[ReviewJob] = Queue()
+    # The outcomes of the reviews are sent back to the process the review came from
+    reply_queues: dict[str, Queue[ReviewReply]] = {}
+
+    def put_audio(
+        self,
+        source: str,
+        audio_path: Path,
+        chat_id: int | None = None,
+        message_id: int | None = None,
+        audio: bytes | None = None,
+    ) -> int:
+        """
+        Queues a recording for the review. If its contents are given in `audio`, the reviewer
+        works from them, and the file at `audio_path` is only needed to resume the job after a crash
+        """
+        return self.__put(
+            self.audio_queue,
+            JobKind.AUDIO,
+            source,
+            audio_path.absolute().as_posix(),
+            chat_id,
+            message_id,
+            audio,
+        )
+
+    def put_text(
+        self,
+        source: str,
+        text_review: str,
+        chat_id: int | None = None,
+        message_id: int | None = None,
+    ) -> int:
+        return self.__put(self.text_queue, JobKind.TEXT, source, text_review, chat_id, message_id)
+
+    def reply(
+        self,
+        job: ReviewJob,
+        outcome: ReplyOutcome,
+        issues: list[Issue] | None = None,
+        text: str = "",
+    ) -> None:
+        self.reply_queues[job.source].put(
+            ReviewReply(
+                job.job_id,
+                job.chat_id,
+                job.message_id,
+                outcome,
+                [(issue.description, issue.department.value) for issue in issues or []],
+                text,
+            )
+        )
+
+    def __put(
+        self,
+        queue: Queue[ReviewJob],
+        kind: JobKind,
+        source: str,
+        payload: str,
+        chat_id: int | None,
+        message_id: int | None,
+        audio: bytes | None = None,
+    ) -> int:
+        # The job is journaled before it is queued, so it survives a crash of any process
+        job_id = JobJournal().add(kind.value, source, payload, chat_id, message_id)
+        queue.put(ReviewJob(job_id, kind, source, payload, chat_id, message_id, getTime(), audio))
+        JOBS_ENQUEUED.labels(kind.value, source).inc()
+
+        return job_id
 
 
 class ReviewContext:
-    def __init__(self, review_queues: ReviewQueues) -> None:
+    """
+    Runs the review pipeline as two stages with their own workers:
+    the transcription stage turns recordings into text, and the analysis stage
+    runs the LLM chain and uploads the result. The stages are linked by a bounded queue,
+    so the next recording is transcribed while the previous one is being analysed.
+    Text reviews skip the transcription stage, and interactive reviews are analysed first.
+
+    The progress of every job is recorded in the `JobJournal`, and the jobs interrupted
+    by a crash or a restart are resumed on startup.
+    """
+
+    def __init__(
+        self,
+        review_queues: ReviewQueues,
+        transcription_workers: int = TRANSCRIPTION_WORKERS,
+        analysis_workers: int = ANALYSIS_WORKERS,
+    ) -> None:
         self.__queues = review_queues
+        self.__transcription_workers = transcription_workers
+        self.__analysis_workers = analysis_workers
+        # Jobs journaled before this moment belong to a previous run
+        self.__started_at = getTime()
 
     def run_reviewing(self) -> None:
         # Setup AIs in specific order
-        AudioTranscriber()
+        self.__transcriber = (
+            TranscriptionPool(TRANSCRIPTION_PROCESSES)
+            if TRANSCRIPTION_PROCESSES > 0
+            else AudioTranscriber()
+        )
         ReviewAnalizer()
 
+        if TRANSCRIPTION_PROCESSES > 0:
+            # One thread to keep every worker process busy
+            self.__transcription_workers = max(
+                self.__transcription_workers, TRANSCRIPTION_PROCESSES
+            )
+
+        # Uploads are sent in the background, so slow responses do not hold the pipeline up
+        UploadOutbox().start_sender()
+
+        self.__journal = JobJournal()
+        self.__dispatcher = ReviewDispatcher(
+            {JobKind.AUDIO: self.__queues.audio_queue},
+            lambda job: audio_duration(self.__audio_of(job)),
+        )
+        # Text reviews need no transcription, so they do not wait for the transcription workers
+        self.__text_dispatcher = ReviewDispatcher({JobKind.TEXT: self.__queues.text_queue})
+        # Only one transcription worker at a time can collect a batch from the dispatcher
+        self.__dispatch_lock = Lock()
+        # (is a batch job, arrival order, job, text): the interactive reviews are analysed first
+        self.__analysis_queue: PriorityQueue[tuple[bool, int, ReviewJob, str]] = PriorityQueue(
+            maxsize=ANALYSIS_QUEUE_SIZE
+        )
+        self.__analysis_arrivals = count()
+
+        self.__resume_interrupted()
+
+        workers = (
+            [
+                Thread(target=self.__run_transcription, name=f"transcription-{index}")
+                for index in range(self.__transcription_workers)
+            ]
+            + [
+                Thread(target=self.__run_text_feeder, name="text-feeder"),
+            ]
+            + [
+                Thread(target=self.__run_analysis, name=f"analysis-{index}")
+                for index in range(self.__analysis_workers)
+            ]
+        )
+
+        logger.info(
+            "Starting review pipeline with %d transcription and %d analysis workers",
+            self.__transcription_workers,
+            self.__analysis_workers,
+        )
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+    def __resume_interrupted(self) -> None:
+        self.__journal.prune()
+
+        interrupted = self.__journal.unfinished(created_before=self.__started_at)
+        if len(interrupted) == 0:
+            return
+
+        logger.info("Resuming %d review jobs interrupted by the previous run...", len(interrupted))
+
+        for entry in interrupted:
+            dispatcher = (
+                self.__text_dispatcher if entry.kind == JobKind.TEXT.value else self.__dispatcher
+            )
+            dispatcher.put(
+                ReviewJob(
+                    entry.job_id,
+                    JobKind(entry.kind),
+                    entry.source,
+                    entry.payload,
+                    entry.chat_id,
+                    entry.message_id,
+                    getTime(),
+                )
+            )
+
+    def __run_transcription(self) -> None:
+        while True:
+            with self.__dispatch_lock:
+                # Blocks until a recording arrives
+                job = self.__dispatcher.get()
+
+                # Transcribe every recording which is already waiting in one pass
+                batch = [job] + self.__dispatcher.get_more(
+                    JobKind.AUDIO, TRANSCRIPTION_BATCH_SIZE - 1, TRANSCRIPTION_BATCH_MAX_WAIT
+                )
+
+            for batch_job in batch:
+                self.__log_wait(batch_job)
+
+            try:
+                self.__transcribe_batch(batch)
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched during audio review: {ex} {ex.args}\n{format_exc()}"
+                )
+                self.__fail_transcription(batch)
+
+    def __run_text_feeder(self) -> None:
+        """Hands the text reviews to the analysis stage directly, most urgent first"""
         while True:
-            if not self.__queues.audio_queue.empty():
-                (strategy, audio_path) = self.__queues.audio_queue.get(block=True, timeout=10)
-                strategy.handle_audio(Path(audio_path))
+            job = self.__text_dispatcher.get()
+            self.__log_wait(job)
+
+            try:
+                self.__put_analysis(job, job.payload)
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched during text review: {ex} {ex.args}\n{format_exc()}"
+                )
+
+    def __transcribe_batch(self, batch: list[ReviewJob]) -> None:
+        # Somebody is waiting for the interactive jobs, so they are reported chunk by chunk
+        for job in batch:
+            if job.interactive:
+                self.__transcribe_streaming(job)
+
+        batch = [job for job in batch if not job.interactive]
+        if len(batch) == 0:
+            return
+
+        for job in batch:
+            self.__journal.set_state(job.job_id, JobState.TRANSCRIBING)
+
+        transcriptions = self.__transcriber.transcribe_batch(
+            [self.__audio_of(job) for job in batch]
+        )
+
+        for job, transcribed in zip(batch, transcriptions):
+            try:
+                self.__finish_transcription(job, transcribed)
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched during audio review: {ex} {ex.args}\n{format_exc()}"
+                )
+
+    def __transcribe_streaming(self, job: ReviewJob) -> None:
+        self.__journal.set_state(job.job_id, JobState.TRANSCRIBING)
+
+        texts: list[str] = []
+        transcribed: str | None = None
+
+        try:
+            for text in self.__transcriber.transcribe_stream(self.__audio_of(job)):
+                if len(texts) == 0:
+                    logger.info(
+                        "Time to first text of job #%s: %.3f seconds since it was queued",
+                        job.job_id,
+                        getTime() - job.enqueued_at,
+                    )
+
+                texts.append(text)
+                self.__queues.reply(job, ReplyOutcome.TRANSCRIPTION_PROGRESS, text=text)
+
+            transcribed = "".join(texts)
+        except Exception as ex:
+            logger.error(
+                f"Exception catched durint audio transcription: {ex} {ex.args}\n{format_exc()}"
+            )
+
+        self.__finish_transcription(job, transcribed)
+
+    def __fail_transcription(self, batch: list[ReviewJob]) -> None:
+        """Marks the jobs of the batch which have not got past the transcription as failed"""
+        for job in batch:
+            try:
+                if self.__journal.state_of(job.job_id) not in (
+                    JobState.QUEUED,
+                    JobState.TRANSCRIBING,
+                ):
+                    continue
+
+                ERRORS.labels("transcription").inc()
+                self.__journal.set_state(job.job_id, JobState.FAILED)
+                self.__queues.reply(job, ReplyOutcome.TRANSCRIPTION_ERROR)
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched durint job #{job.job_id} failing: "
+                    f"{ex} {ex.args}\n{format_exc()}"
+                )
+
+    def __finish_transcription(self, job: ReviewJob, transcribed: str | None) -> None:
+        if transcribed is None:
+            logger.warning("Transcription returned an empty value. Error?")
+            ERRORS.labels("transcription").inc()
+            self.__journal.set_state(job.job_id, JobState.FAILED)
+            self.__queues.reply(job, ReplyOutcome.TRANSCRIPTION_ERROR)
+            return
+
+        if transcribed.strip() == "":
+            logger.info("Recording of job #%s does not contain speech.", job.job_id)
+            self.__journal.set_state(job.job_id, JobState.DONE)
+            self.__queues.reply(job, ReplyOutcome.NO_SPEECH)
+            return
+
+        # Blocks if the analysis stage is falling behind.
+        # The recording is not needed anymore, so it is not held in memory while waiting
+        self.__put_analysis(job._replace(audio=None), transcribed)
+
+    def __put_analysis(self, job: ReviewJob, text_review: str) -> None:
+        self.__analysis_queue.put(
+            (job.priority is JobPriority.BATCH, next(self.__analysis_arrivals), job, text_review)
+        )
+
+    def __run_analysis(self) -> None:
+        while True:
+            (_, _, job, text_review) = self.__analysis_queue.get()
+
+            try:
+                self.__analyse(job, text_review)
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched during review analysis: {ex} {ex.args}\n{format_exc()}"
+                )
+                self.__fail_analysis(job)
+
+    def __fail_analysis(self, job: ReviewJob) -> None:
+        """Marks a job the analysis or the upload has raised for as failed"""
+        try:
+            state = self.__journal.state_of(job.job_id)
+            if state in (JobState.DONE, JobState.FAILED):
+                return
+
+            ERRORS.labels("analysis" if state is not JobState.UPLOADING else "upload").inc()
+            self.__journal.set_state(job.job_id, JobState.FAILED)
+            self.__queues.reply(
+                job,
+                ReplyOutcome.UPLOAD_ERROR
+                if state is JobState.UPLOADING
+                else ReplyOutcome.ANALYSIS_ERROR,
+            )
+        except Exception as ex:
+            logger.error(
+                f"Exception catched durint job #{job.job_id} failing: "
+                f"{ex} {ex.args}\n{format_exc()}"
+            )
+
+    def __analyse(self, job: ReviewJob, text_review: str) -> None:
+        self.__journal.set_state(job.job_id, JobState.ANALYSING)
+
+        # Whisper has translated the recordings to English already,
+        # only the typed reviews need the translation
+        review = ReviewAnalizer().summarize_review(
+            text_review, english=job.kind is JobKind.AUDIO and WHISPER_TRANSLATION
+        )
+
+        if review is None:
+            logger.warning("Review analizer returned an empty value. Error?")
+            ERRORS.labels("analysis").inc()
+            self.__journal.set_state(job.job_id, JobState.FAILED)
+            self.__queues.reply(job, ReplyOutcome.ANALYSIS_ERROR)
+            return
+
+        self.__queues.reply(job, ReplyOutcome.REVIEW_DONE, review.issues)
+
+        self.__journal.set_state(job.job_id, JobState.UPLOADING)
+
+        if not upload_review(
+            audio_review_path=Path(job.payload) if job.kind is JobKind.AUDIO else None,
+            text_review=review.corrected_text,
+            text_summary=review.summary,
+            issues=review.issues,
+        ):
+            self.__journal.set_state(job.job_id, JobState.FAILED)
+            self.__queues.reply(job, ReplyOutcome.UPLOAD_ERROR)
+            return
+
+        self.__journal.set_state(job.job_id, JobState.DONE)
+
+    def __audio_of(self, job: ReviewJob) -> Path | BufferedAudio:
+        if job.audio is None:
+            return Path(job.payload)
+
+        return BufferedAudio(Path(job.payload), job.audio)
 
-            if not self.__queues.text_queue.empty():
-                (strategy, text_review) = self.__queues.text_queue.get(block=True, timeout=10)
-                strategy.handle_text(text_review)
+    def __log_wait(self, job: ReviewJob) -> None:
+        JOB_WAIT.labels(job.kind.value, job.priority.value).observe(getTime() - job.enqueued_at)
 
-            sleep(1)
+        logger.info(
+            "Starting %s %s job #%s from %s, waited %.3f seconds in the queue",
+            job.priority.value,
+            job.kind.value,
+            job.job_id,
+            job.source,
+            getTime() - job.enqueued_at,
+        )
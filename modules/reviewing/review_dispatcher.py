@@ -0,0 +1,138 @@
+import heapq
+
+from itertools import count
+from logging import getLogger
+from queue import Empty
+from threading import Condition, Thread
+from time import time as getTime
+from typing import Any, Callable
+
+from .review_job import JobKind, JobPriority, ReviewJob
+from settings import (
+    LOGGER_NAME,
+    SCHEDULER_BATCH_DELAY,
+    SCHEDULER_DURATION_WEIGHT,
+    SCHEDULER_UNKNOWN_DURATION,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class ReviewDispatcher:
+    """
+    Merges several source queues into a single blocking one, ordered by priority.
+
+    Every source queue gets a feeder thread which blocks on `get()` and schedules the jobs
+    as they arrive, so the consumer wakes up as soon as a job arrives on any source.
+
+    Every job gets a virtual deadline: the time it was queued, plus a delay of its priority class,
+    plus its estimated duration. The job with the earliest deadline is served first, so interactive
+    jobs go ahead of the device batch and short recordings ahead of long ones, while a job which
+    has waited longer than the delay of its class is not overtaken anymore.
+    """
+
+    def __init__(
+        self,
+        sources: dict[JobKind, Any],
+        duration_of: Callable[[ReviewJob], float | None] = lambda job: None,
+    ) -> None:
+        self.__duration_of = duration_of
+        self.__condition = Condition()
+        # (deadline, arrival order, job)
+        self.__heap: list[tuple[float, int, ReviewJob]] = []
+        self.__arrivals = count()
+
+        for kind, source in sources.items():
+            Thread(
+                target=self.__feed, args=(kind, source), name=f"{kind.value}-feeder", daemon=True
+            ).start()
+
+    def put(self, job: ReviewJob) -> None:
+        """Queues a job which did not come from the sources, e.g. a resumed one"""
+        self.__schedule(job)
+
+    def get(self, timeout: float | None = None) -> ReviewJob:
+        """
+        Blocks until the next job is available and returns the most urgent one.
+
+        Raises `queue.Empty` if `timeout` is given and no job arrived in time.
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: len(self.__heap) > 0, timeout=timeout):
+                raise Empty
+
+            return heapq.heappop(self.__heap)[2]
+
+    def get_more(self, kind: JobKind, max_count: int, max_wait: float) -> list[ReviewJob]:
+        """
+        Collects up to `max_count` more jobs of the given `kind`, most urgent first,
+        waiting at most `max_wait` seconds for them to arrive.
+
+        Jobs of other kinds stay in the queue.
+        """
+        batch: list[ReviewJob] = []
+        deadline = getTime() + max_wait
+
+        with self.__condition:
+            while True:
+                batch += self.__take(kind, max_count - len(batch))
+
+                remaining = deadline - getTime()
+                if len(batch) >= max_count or remaining <= 0:
+                    return batch
+
+                self.__condition.wait(timeout=remaining)
+
+    def __take(self, kind: JobKind, max_count: int) -> list[ReviewJob]:
+        if max_count <= 0:
+            return []
+
+        taken = heapq.nsmallest(
+            max_count, (entry for entry in self.__heap if entry[2].kind is kind)
+        )
+        if len(taken) == 0:
+            return []
+
+        taken_ids = {id(entry) for entry in taken}
+        self.__heap = [entry for entry in self.__heap if id(entry) not in taken_ids]
+        heapq.heapify(self.__heap)
+
+        return [entry[2] for entry in taken]
+
+    def __schedule(self, job: ReviewJob) -> None:
+        # Estimated outside of the lock, reading the header may touch the disk
+        deadline = self.__deadline(job)
+
+        with self.__condition:
+            heapq.heappush(self.__heap, (deadline, next(self.__arrivals), job))
+            self.__condition.notify()
+
+    def __deadline(self, job: ReviewJob) -> float:
+        if job.kind is JobKind.TEXT:
+            duration = 0.0
+        else:
+            try:
+                duration = self.__duration_of(job)
+            except Exception as ex:
+                logger.warning("Could not estimate the duration of job #%s: %s", job.job_id, ex)
+                duration = None
+
+        if duration is None:
+            duration = SCHEDULER_UNKNOWN_DURATION
+
+        delay = SCHEDULER_BATCH_DELAY if job.priority is JobPriority.BATCH else 0.0
+
+        return job.enqueued_at + delay + duration * SCHEDULER_DURATION_WEIGHT
+
+    def __feed(self, kind: JobKind, source) -> None:
+        while True:
+            try:
+                job: ReviewJob = source.get(block=True)
+            except (EOFError, OSError):
+                logger.warning(
+                    "The %s source queue has been closed. Stopping its feeder.", kind.value
+                )
+                return
+
+            self.__schedule(job)
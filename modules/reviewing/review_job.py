@@ -0,0 +1,65 @@
+from enum import Enum
+from typing import NamedTuple
+
+
+class JobKind(Enum):
+    AUDIO = "audio"
+    TEXT = "text"
+
+
+class JobPriority(Enum):
+    # somebody is waiting in a chat
+    INTERACTIVE = "interactive"
+    # recordings of the devices
+    BATCH = "batch"
+
+
+class ReplyOutcome(Enum):
+    # A part of the transcription is ready, the review goes on
+    TRANSCRIPTION_PROGRESS = "transcription_progress"
+    TRANSCRIPTION_ERROR = "transcription_error"
+    NO_SPEECH = "no_speech"
+    ANALYSIS_ERROR = "analysis_error"
+    REVIEW_DONE = "review_done"
+    UPLOAD_ERROR = "upload_error"
+
+
+class ReviewJob(NamedTuple):
+    """
+    A review job as it travels between the processes.
+
+    Only plain values are sent, the ingest process keeps the knowledge
+    of how to talk to the reviewer, and gets the outcome back as a `ReviewReply`.
+    """
+
+    job_id: int
+    kind: JobKind
+    source: str
+    # Path to the audio file, or the text of the review
+    payload: str
+    chat_id: int | None
+    message_id: int | None
+    enqueued_at: float
+    # Contents of a recording received into memory,
+    # its file at `payload` is written in the background
+    audio: bytes | None = None
+
+    @property
+    def interactive(self) -> bool:
+        """Whether somebody is waiting in a chat for the outcome of the review"""
+        return self.chat_id is not None
+
+    @property
+    def priority(self) -> JobPriority:
+        return JobPriority.INTERACTIVE if self.interactive else JobPriority.BATCH
+
+
+class ReviewReply(NamedTuple):
+    job_id: int
+    chat_id: int | None
+    message_id: int | None
+    outcome: ReplyOutcome
+    # (description, department) pairs of the issues found in the review
+    issues: list[tuple[str, str]]
+    # The transcribed text of a progress reply
+    text: str = ""
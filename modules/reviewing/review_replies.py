@@ -0,0 +1,50 @@
+from logging import getLogger
+from threading import Thread
+from traceback import format_exc
+from typing import Callable
+
+from .review_job import ReviewReply, ReplyOutcome
+from .review_strategy import ReviewStrategy
+from settings import LOGGER_NAME
+
+
+logger = getLogger(LOGGER_NAME)
+
+
+class ReplyListener:
+    """
+    Receives the replies of the reviewing process in an ingest process,
+    and applies the strategy made for every job by `make_strategy`.
+
+    The strategy of a job is kept while its progress replies arrive,
+    and is forgotten after the job's final reply.
+    """
+
+    def __init__(self, reply_queue, make_strategy: Callable[[ReviewReply], ReviewStrategy]) -> None:
+        self.__reply_queue = reply_queue
+        self.__make_strategy = make_strategy
+        self.__strategies: dict[int, ReviewStrategy] = {}
+
+    def start(self) -> None:
+        Thread(target=self.__run, name="reply-listener", daemon=True).start()
+
+    def __run(self) -> None:
+        while True:
+            try:
+                reply: ReviewReply = self.__reply_queue.get(block=True)
+            except (EOFError, OSError):
+                logger.warning("The reply queue has been closed. Stopping the reply listener.")
+                return
+
+            try:
+                strategy = self.__strategies.pop(reply.job_id, None) or self.__make_strategy(reply)
+
+                if reply.outcome is ReplyOutcome.TRANSCRIPTION_PROGRESS:
+                    self.__strategies[reply.job_id] = strategy
+
+                strategy.handle_reply(reply)
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched during handling reply of job #{reply.job_id}: "
+                    f"{ex} {ex.args}\n{format_exc()}"
+                )
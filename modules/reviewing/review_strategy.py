@@ -1,11 +1,59 @@
-from pathlib import Path
 from abc import ABC, abstractmethod
 
+from .review_job import ReviewReply, ReplyOutcome
+from modules.models.issue import Issue, IssueDepartment
+
+
 class ReviewStrategy(ABC):
+    """
+    Decides how the outcome of a review is delivered back to where the review came from.
+
+    The review itself (transcription, analysis and upload) is done by `ReviewContext`
+    in the reviewing process, the strategies are applied to its replies in the ingest processes.
+    """
+
+    # Identifies the source of the reviews and its reply channel
+    SOURCE = ""
+
+    def handle_reply(self, reply: ReviewReply) -> None:
+        if reply.outcome is ReplyOutcome.TRANSCRIPTION_PROGRESS:
+            self.handle_progress(reply.text)
+        elif reply.outcome is ReplyOutcome.TRANSCRIPTION_ERROR:
+            self.handle_transcription_error()
+        elif reply.outcome is ReplyOutcome.NO_SPEECH:
+            self.handle_no_speech()
+        elif reply.outcome is ReplyOutcome.ANALYSIS_ERROR:
+            self.handle_analysis_error()
+        elif reply.outcome is ReplyOutcome.REVIEW_DONE:
+            self.handle_review(
+                [
+                    Issue(description, IssueDepartment(department))
+                    for description, department in reply.issues
+                ]
+            )
+        elif reply.outcome is ReplyOutcome.UPLOAD_ERROR:
+            self.handle_upload_error()
+
     @abstractmethod
-    def handle_audio(self, audio_path: Path) -> None:
+    def handle_progress(self, transcribed_part: str) -> None:
         pass
 
     @abstractmethod
-    def handle_text(self, text_message: str) -> None:
-        pass
\ No newline at end of file
+    def handle_transcription_error(self) -> None:
+        pass
+
+    @abstractmethod
+    def handle_no_speech(self) -> None:
+        pass
+
+    @abstractmethod
+    def handle_analysis_error(self) -> None:
+        pass
+
+    @abstractmethod
+    def handle_review(self, issues: list[Issue]) -> None:
+        pass
+
+    @abstractmethod
+    def handle_upload_error(self) -> None:
+        pass
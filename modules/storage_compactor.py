@@ -0,0 +1,477 @@
+import os
+import re
+import json
+import sqlite3
+import zipfile
+import subprocess
+
+from datetime import date, datetime
+from logging import getLogger
+from pathlib import Path
+from time import sleep
+from time import time as getTime
+from traceback import format_exc
+from typing import NamedTuple
+
+from modules.ais.audio_preprocessor import AudioPreprocessor, audio_duration
+from settings import (
+    LOGGER_NAME,
+    ALLOWED_EXTENSIONS,
+    RECORDINGS_FOLDER,
+    TELEGRAM_AUDIO_DIR,
+    STORAGE_ROOT,
+    STORAGE_ARCHIVE_DIR,
+    STORAGE_ARCHIVE_INDEX_PATH,
+    STORAGE_COMPACTION_MIN_AGE,
+    STORAGE_ARCHIVE_RETENTION,
+    STORAGE_COMPACTION_INTERVAL,
+    STORAGE_COMPACTION_MAX_BACKLOG,
+    STORAGE_COMPACTION_BYTES_PER_SECOND,
+)
+
+
+logger = getLogger(LOGGER_NAME)
+
+# Files a recording leaves behind, by their suffix. The longer suffixes go first,
+# so the archival "_speech.ogg" is not taken for a raw .ogg recording
+OPUS_SUFFIX = "_speech.ogg"
+TRANSCRIPTION_SUFFIX = ".txt"
+ORIGINAL_TRANSCRIPTION_SUFFIX = ".original.txt"
+RECORDING_SUFFIXES = [
+    OPUS_SUFFIX,
+    ORIGINAL_TRANSCRIPTION_SUFFIX,
+    TRANSCRIPTION_SUFFIX,
+    *ALLOWED_EXTENSIONS,
+]
+# Only these are kept in the archives, the raw recordings are dropped
+KEPT_SUFFIXES = [OPUS_SUFFIX, ORIGINAL_TRANSCRIPTION_SUFFIX, TRANSCRIPTION_SUFFIX]
+
+# "2025-01-31.zip", or "2025-01-31.2.zip" for the recordings of the same day compacted later
+ARCHIVE_NAME = re.compile(r"^(\d{4}-\d{2}-\d{2})(\.\d+)?\.zip$")
+COPY_CHUNK_SIZE = 256 * 1024
+# How much shorter than the raw recording its archival copy may be, the encoder pads and trims
+OPUS_DURATION_TOLERANCE = 1.0
+
+
+class Recording(NamedTuple):
+    # path relative to the storage root, without the suffix
+    name: str
+    files: dict[str, Path]
+    # time the newest of its files was written
+    recorded_at: float
+
+    @property
+    def opus(self) -> Path | None:
+        return self.files.get(OPUS_SUFFIX)
+
+    @property
+    def raw(self) -> Path | None:
+        return next(
+            (self.files[suffix] for suffix in ALLOWED_EXTENSIONS if suffix in self.files), None
+        )
+
+
+class StorageCompactor:
+    """
+    Packs the files of the finished recordings into dated archives, and deletes the old archives.
+
+    Only the archival Opus file and the transcriptions of a recording are kept, the raw recording
+    is dropped. Every archive is a ZIP file of the recordings of one day, written under
+    a temporary name and never changed after, and the `STORAGE_ARCHIVE_INDEX_PATH` database
+    records which archive holds which recording, with its transcription.
+
+    Runs in its own low priority process, only while the review pipeline is idle,
+    and at most at `STORAGE_COMPACTION_BYTES_PER_SECOND`, so it does not slow the reviews down.
+    """
+
+    def __init__(
+        self,
+        root: Path = STORAGE_ROOT,
+        archive_dir: Path = STORAGE_ARCHIVE_DIR,
+        index_path: Path = STORAGE_ARCHIVE_INDEX_PATH,
+    ) -> None:
+        self.__root = root
+        self.__archive_dir = archive_dir
+        self.__index_path = index_path
+        self.__connection: sqlite3.Connection | None = None
+        self.__throttle_started_at = 0.0
+        self.__throttle_bytes = 0
+        self.__preprocessor: AudioPreprocessor | None = None
+        # Recordings whose archival copy could not be made, with the time they were written at,
+        # so they are not archived again until they change
+        self.__unarchivable: set[tuple[str, float]] = set()
+
+    def run_compaction(self) -> None:
+        self.__lower_priority()
+        self.__open_index()
+
+        logger.info("Storage compaction has been started for %s", self.__root)
+
+        while True:
+            try:
+                self.compact()
+            except Exception as ex:
+                logger.error(
+                    f"Exception catched durint storage compaction: {ex} {ex.args}\n{format_exc()}"
+                )
+
+            sleep(STORAGE_COMPACTION_INTERVAL)
+
+    def compact(self) -> None:
+        """Runs a single compaction: expires the old archives and packs the old recordings"""
+        if self.__connection is None:
+            self.__open_index()
+
+        self.__expire_archives()
+
+        if self.__busy():
+            logger.debug("The review pipeline is busy. Postponing the storage compaction.")
+            return
+
+        in_use = self.__recordings_in_use()
+        by_day: dict[date, list[Recording]] = {}
+
+        for recording in self.__find_recordings():
+            if (
+                recording.name in in_use
+                or getTime() - recording.recorded_at < STORAGE_COMPACTION_MIN_AGE
+            ):
+                continue
+
+            if self.__archived_in(recording) is not None:
+                # Packed before, but the process was stopped before its files were deleted
+                self.__delete_files(recording)
+                continue
+
+            if recording.raw is not None and not self.__has_valid_opus(recording):
+                # The audio would be lost without its archival copy. The new copy makes
+                # the recording newer, so it is packed by a later compaction
+                if self.__busy():
+                    logger.info("The review pipeline got busy. Pausing the storage compaction.")
+                    return
+
+                self.__archive_recording(recording)
+                continue
+
+            by_day.setdefault(date.fromtimestamp(recording.recorded_at), []).append(recording)
+
+        for day, recordings in sorted(by_day.items()):
+            if not self.__pack(
+                day, sorted(recordings, key=lambda recording: recording.recorded_at)
+            ):
+                # Stopped because the pipeline got busy
+                return
+
+    def __has_valid_opus(self, recording: Recording) -> bool:
+        """
+        Checks that the archival copy of the recording can be read, and is not cut short,
+        before its raw recording is dropped
+        """
+        if recording.opus is None:
+            return False
+
+        opus_duration = audio_duration(recording.opus)
+        if opus_duration is None:
+            return False
+
+        raw_duration = audio_duration(recording.raw) if recording.raw is not None else None
+        return raw_duration is None or opus_duration >= raw_duration - OPUS_DURATION_TOLERANCE
+
+    def __archive_recording(self, recording: Recording) -> None:
+        """Makes the missing archival copy of the recording from its raw recording"""
+        if (recording.name, recording.recorded_at) in self.__unarchivable:
+            return
+
+        raw = recording.raw
+        assert raw is not None
+
+        logger.info("Recording %s has no valid archival .ogg file. Archiving it...", recording.name)
+
+        if self.__preprocessor is None:
+            self.__preprocessor = AudioPreprocessor()
+
+        if self.__preprocessor.archive_recording_async(raw).result() is None:
+            self.__unarchivable.add((recording.name, recording.recorded_at))
+            logger.warning(
+                "Recording %s could not be archived. Leaving it uncompacted.", recording.name
+            )
+
+    def __pack(self, day: date, recordings: list[Recording]) -> bool:
+        """
+        Packs the recordings into a new archive of the given day.
+        Returns `False` if it was stopped because the review pipeline got busy
+        """
+        archive_path = self.__new_archive_path(day)
+        part_path = archive_path.with_name(f"{archive_path.name}.part")
+        packed: list[tuple[Recording, list[str]]] = []
+        finished = True
+
+        logger.info(
+            "Packing %d recordings of %s into %s...", len(recordings), day.isoformat(), archive_path
+        )
+
+        # Opus is compressed already, so the files are only stored
+        with zipfile.ZipFile(part_path, "w", zipfile.ZIP_STORED) as archive:
+            for recording in recordings:
+                if self.__busy():
+                    logger.info("The review pipeline got busy. Pausing the storage compaction.")
+                    finished = False
+                    break
+
+                members = []
+                for suffix in KEPT_SUFFIXES:
+                    if suffix in recording.files:
+                        members.append(f"{recording.name}{suffix}")
+                        self.__copy_into(archive, recording.files[suffix], members[-1])
+
+                packed.append((recording, members))
+
+        if len(packed) == 0:
+            part_path.unlink(missing_ok=True)
+            return finished
+
+        # The archive has to be on the disk before the recordings are deleted
+        with open(part_path, "rb") as part_file:
+            os.fsync(part_file.fileno())
+        part_path.replace(archive_path)
+
+        for recording, members in packed:
+            self.__index(archive_path, recording, members)
+            self.__delete_files(recording)
+
+        logger.info("%d recordings have been packed into %s", len(packed), archive_path)
+        return finished
+
+    def __copy_into(self, archive: zipfile.ZipFile, path: Path, member: str) -> None:
+        info = zipfile.ZipInfo.from_file(path, member)
+
+        with open(path, "rb") as source, archive.open(info, "w") as target:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                target.write(chunk)
+                self.__throttle(len(chunk))
+
+    def __throttle(self, size: int) -> None:
+        """Sleeps long enough to keep the copying under `STORAGE_COMPACTION_BYTES_PER_SECOND`"""
+        now = getTime()
+
+        # The budget is restarted after a pause, so the idle time does not allow a burst
+        if now - self.__throttle_started_at > 1:
+            self.__throttle_started_at = now
+            self.__throttle_bytes = 0
+
+        self.__throttle_bytes += size
+        ahead = self.__throttle_bytes / STORAGE_COMPACTION_BYTES_PER_SECOND - (
+            now - self.__throttle_started_at
+        )
+
+        if ahead > 0:
+            sleep(ahead)
+
+    def __recording_dirs(self) -> list[Path]:
+        """
+        The directories the recordings are received into. The rest of the home directories
+        belongs to the FTP users, and is never touched
+        """
+        root = self.__root.absolute()
+        directories = [path for path in root.rglob(RECORDINGS_FOLDER) if path.is_dir()]
+
+        telegram_dir = TELEGRAM_AUDIO_DIR.absolute()
+        if telegram_dir.is_dir() and telegram_dir.is_relative_to(root):
+            directories.append(telegram_dir)
+
+        return directories
+
+    def __find_recordings(self) -> list[Recording]:
+        root = self.__root.absolute()
+        files: dict[str, dict[str, Path]] = {}
+
+        for directory in self.__recording_dirs():
+            for path in directory.iterdir():
+                if not path.is_file():
+                    continue
+
+                for suffix in RECORDING_SUFFIXES:
+                    if path.name.endswith(suffix) and len(path.name) > len(suffix):
+                        name = (
+                            path.relative_to(root).with_name(path.name[: -len(suffix)]).as_posix()
+                        )
+                        files.setdefault(name, {})[suffix] = path
+                        break
+
+        recordings = []
+        for name, recording_files in files.items():
+            # Only the audio makes a recording, transcriptions alone may be anything
+            if OPUS_SUFFIX not in recording_files and not any(
+                suffix in recording_files for suffix in ALLOWED_EXTENSIONS
+            ):
+                continue
+
+            try:
+                recorded_at = max(path.stat().st_mtime for path in recording_files.values())
+            except FileNotFoundError:
+                # Deleted meanwhile
+                continue
+
+            recordings.append(Recording(name, recording_files, recorded_at))
+
+        return recordings
+
+    def __recordings_in_use(self) -> set[str]:
+        """Names of the recordings the unfinished reviews and the pending uploads still need"""
+        # Imported here, so the compactor does not depend on the reviewing package on import
+        from modules.reviewing.job_journal import JobJournal
+        from modules.endpoints.upload_outbox import UploadOutbox
+
+        paths = JobJournal().unfinished_payloads("audio") | UploadOutbox().pending_audio_paths()
+        root = self.__root.absolute()
+        in_use = set()
+
+        for path in paths:
+            absolute = Path(path).absolute()
+            if not absolute.is_relative_to(root):
+                continue
+
+            # The archival copy of a recording has the same name
+            in_use.add(absolute.relative_to(root).with_suffix("").as_posix())
+
+        return in_use
+
+    def __busy(self) -> bool:
+        from modules.reviewing.job_journal import JobJournal
+
+        return sum(JobJournal().unfinished_counts().values()) > STORAGE_COMPACTION_MAX_BACKLOG
+
+    def __delete_files(self, recording: Recording) -> None:
+        # The newest file goes last, so files left by an interrupted deletion
+        # still have the time the recording was indexed with
+        for path in sorted(recording.files.values(), key=self.__modified_at):
+            path.unlink(missing_ok=True)
+
+    def __modified_at(self, path: Path) -> float:
+        try:
+            return path.stat().st_mtime
+        except FileNotFoundError:
+            return 0.0
+
+    def __new_archive_path(self, day: date) -> Path:
+        archive_path = self.__archive_dir / f"{day.isoformat()}.zip"
+        sequence = 1
+
+        # Archives are never appended to, recordings of the same day compacted later get a new one
+        while archive_path.exists():
+            archive_path = self.__archive_dir / f"{day.isoformat()}.{sequence}.zip"
+            sequence += 1
+
+        return archive_path
+
+    def __expire_archives(self) -> None:
+        if STORAGE_ARCHIVE_RETENTION is None:
+            return
+
+        oldest_kept = datetime.fromtimestamp(getTime() - STORAGE_ARCHIVE_RETENTION).date()
+
+        for archive_path in self.__archive_dir.iterdir():
+            match = ARCHIVE_NAME.match(archive_path.name)
+            if match is None:
+                if archive_path.name.endswith(".zip.part"):
+                    # Left by a compaction which was stopped, its recordings are still in place
+                    archive_path.unlink(missing_ok=True)
+                continue
+
+            if date.fromisoformat(match.group(1)) >= oldest_kept:
+                continue
+
+            logger.info("Deleting the archive %s, it is older than the retention", archive_path)
+            archive_path.unlink(missing_ok=True)
+
+            connection = self.__connection
+            assert connection is not None
+            connection.execute("DELETE FROM recordings WHERE archive = ?", (archive_path.name,))
+            connection.commit()
+
+    def __open_index(self) -> None:
+        self.__index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.__connection = sqlite3.connect(self.__index_path.as_posix(), timeout=30)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS recordings ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, "
+            "archive TEXT NOT NULL, members TEXT NOT NULL, "
+            "recorded_at REAL NOT NULL, archived_at REAL NOT NULL, "
+            "transcription TEXT, original_transcription TEXT)"
+        )
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS recordings_archive ON recordings (archive)"
+        )
+        # A name can be used again by a later recording, which is then archived separately
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS recordings_name ON recordings (name, recorded_at)"
+        )
+        self.__connection.commit()
+
+    def __index(self, archive_path: Path, recording: Recording, members: list[str]) -> None:
+        connection = self.__connection
+        assert connection is not None
+
+        connection.execute(
+            "INSERT INTO recordings (name, archive, members, recorded_at, archived_at, "
+            "transcription, original_transcription) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                recording.name,
+                archive_path.name,
+                json.dumps(members),
+                recording.recorded_at,
+                getTime(),
+                self.__read_text(recording.files.get(TRANSCRIPTION_SUFFIX)),
+                self.__read_text(recording.files.get(ORIGINAL_TRANSCRIPTION_SUFFIX)),
+            ),
+        )
+        connection.commit()
+
+    def __archived_in(self, recording: Recording) -> Path | None:
+        """
+        Returns the archive this very recording has been packed into, or `None` if it has not been.
+        A recording is only taken for an archived one with the same name if it was written
+        at the same time, and its kept files are all in the archive
+        """
+        connection = self.__connection
+        assert connection is not None
+
+        row = connection.execute(
+            "SELECT archive, members FROM recordings WHERE name = ? AND recorded_at = ?",
+            (recording.name, recording.recorded_at),
+        ).fetchone()
+        if row is None or not (self.__archive_dir / row[0]).exists():
+            return None
+
+        members = set(json.loads(row[1]))
+        if any(
+            f"{recording.name}{suffix}" not in members
+            for suffix in recording.files
+            if suffix in KEPT_SUFFIXES
+        ):
+            return None
+
+        return self.__archive_dir / row[0]
+
+    def __read_text(self, path: Path | None) -> str | None:
+        if path is None:
+            return None
+
+        return path.read_bytes().decode("utf-8", errors="replace")
+
+    def __lower_priority(self) -> None:
+        """Lets the reviewing process go first for the CPU and the disk"""
+        os.nice(10)
+
+        try:
+            # The idle I/O class only gets the disk when nobody else uses it
+            subprocess.run(
+                ["ionice", "-c", "3", "-p", str(os.getpid())],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError) as ex:
+            logger.warning("Could not lower the I/O priority of the storage compaction: %s", ex)
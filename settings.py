@@ -8,6 +8,15 @@ LOGGER_NAME = "logging"
 
 # log message format
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(module)s - %(message)s"
+# the log file, written by a single logging process for all the others
+LOG_FILE = Path("./logs/transcriber.log")
+# write the log file as one JSON object per line, the console keeps LOG_FORMAT
+LOG_JSON = True
+# prompts, responses and transcriptions are cut to this many characters in the log,
+# None to log them whole
+LOG_PAYLOAD_MAX_CHARS: int | None = 1_000
+# the share of the prompts (and their responses) which are logged at all, from 0 to 1
+LOG_PAYLOAD_SAMPLE_RATE = 0.1
 
 # the folder in which data from esps is stored
 RECORDINGS_FOLDER = "esp-recordings"
@@ -17,10 +26,206 @@ DELETE_CONVERTED_FILES = False
 
 ALLOWED_EXTENSIONS = [".wav", ".mp3", ".ogg"]
 
+# recordings uploaded over FTP are received into memory and handed to the reviewer directly,
+# their files are written in the background
+FTP_MEMORY_INGEST = True
+# recordings larger than this (in bytes) are written straight to the disk instead
+FTP_MEMORY_INGEST_LIMIT = 32 * 1024 * 1024
+
+# how the speech recognition model runs on machines without CUDA:
+# "float32" - the original model, "int8" - dynamically quantized linear layers,
+# "onnx" - the model exported to ONNX Runtime with optimum
+# TRANSCRIBER_CPU_MODE = "float32"
+# TRANSCRIBER_CPU_MODE = "onnx"
+TRANSCRIBER_CPU_MODE = "int8"
+# torch threads on CPU, None to keep the torch defaults
+TORCH_INTRA_OP_THREADS: int | None = None
+TORCH_INTER_OP_THREADS: int | None = None
+# run the model once on startup and log its real-time factor
+TRANSCRIBER_WARM_UP = True
+TRANSCRIBER_WARM_UP_SECONDS = 5
+
+# detect the language of every recording, and let Whisper translate the speech
+# which is not in English, so the review analysis does not need to translate it
+# (the original text is kept next to the English one)
+# WHISPER_TRANSLATION = False
+WHISPER_TRANSLATION = True
+
+# transcribe in this many worker processes, each with its own copy of the model,
+# 0 to run the model in the reviewing process itself
+TRANSCRIPTION_PROCESSES = 0
+# CPU cores every worker process is pinned to, e.g. [[0, 1, 2, 3], [4, 5, 6, 7]],
+# None to split the available cores evenly between them
+TRANSCRIPTION_PROCESS_CORES: list[list[int]] | None = None
+# device of every worker process, e.g. ["cuda:0", "cuda:1"], None to let the model choose
+TRANSCRIPTION_PROCESS_DEVICES: list[str] | None = None
+# workers report every TRANSCRIPTION_HEALTH_INTERVAL seconds,
+# and are restarted if they die or do not report for TRANSCRIPTION_HEALTH_TIMEOUT seconds
+TRANSCRIPTION_HEALTH_INTERVAL = 5
+TRANSCRIPTION_HEALTH_TIMEOUT = 60
+# a worker is also restarted when a request takes longer than TRANSCRIPTION_REQUEST_TIMEOUT seconds
+# plus TRANSCRIPTION_REQUEST_SECONDS_PER_AUDIO_SECOND for every second of its audio
+TRANSCRIPTION_REQUEST_TIMEOUT = 120
+TRANSCRIPTION_REQUEST_SECONDS_PER_AUDIO_SECOND = 3.0
+
+# how many queued recordings can be transcribed by the model in one pass
+TRANSCRIPTION_BATCH_SIZE = 8
+# how long (in seconds) to wait for more recordings to fill a batch
+TRANSCRIPTION_BATCH_MAX_WAIT = 0.25
+
+# analyse a review with a single JSON-schema-constrained prompt,
+# falling back to the chain of separate prompts if the response can not be parsed
+# STRUCTURED_ANALYSIS = False
+STRUCTURED_ANALYSIS = True
+
+# send the prompts which do not depend on each other to Ollama concurrently,
+# at most OLLAMA_MAX_CONCURRENCY at a time (match it with OLLAMA_NUM_PARALLEL of the server)
+CONCURRENT_ANALYSIS = True
+OLLAMA_MAX_CONCURRENCY = 4
+
+# interactive recordings are transcribed and reported in chunks of this length (in seconds)
+STREAMING_CHUNK_SECONDS = 30
+
+# skip recordings without speech, and transcribe only the voiced parts of the others
+VAD_ENABLED = True
+# recordings with less speech than this are dropped
+VAD_MIN_SPEECH_SECONDS = 0.5
+VAD_MIN_SPEECH_RATIO = 0.02
+# detector tuning
+VAD_FRAME_SECONDS = 0.03
+VAD_MIN_ENERGY_DB = -50
+VAD_ENERGY_MARGIN_DB = 10
+# frames louder than this are loud enough for speech whatever the noise floor is,
+# so speech without pauses, which has no quiet frames to estimate the floor from, is not dropped
+VAD_SPEECH_ENERGY_DB = -35
+VAD_MAX_ZERO_CROSSING_RATE = 0.35
+VAD_MIN_REGION_SECONDS = 0.15
+VAD_MAX_GAP_SECONDS = 0.5
+VAD_PADDING_SECONDS = 0.3
+
+# worker threads of the review pipeline stages
+TRANSCRIPTION_WORKERS = 1
+ANALYSIS_WORKERS = 2
+# how many transcribed reviews can wait for the analysis stage before transcription pauses
+ANALYSIS_QUEUE_SIZE = 16
+
+# the most urgent review job is served first: interactive jobs are ahead of the device batch
+# until a batch job has waited this long (in seconds),
+SCHEDULER_BATCH_DELAY = 10 * 60
+# and within a class shorter recordings go first, as if they were queued earlier
+# by this many seconds per second of audio
+SCHEDULER_DURATION_WEIGHT = 1.0
+# recordings whose duration can not be read from the header are taken to be this long (in seconds)
+SCHEDULER_UNKNOWN_DURATION = 60
+
+# admission control of new reviews, driven by the backlog in the job journal:
+# devices are asked to retry later when the backlog is larger than this many jobs,
+ADMISSION_MAX_BACKLOG = 200
+# or would take longer than this (in seconds) to drain
+ADMISSION_MAX_DEVICE_DRAIN = 30 * 60
+# FTP recordings are only sent between the processes in memory
+# while the backlog is smaller than this
+ADMISSION_MEMORY_BACKLOG = 16
+# Telegram users are told how long to wait
+# when the backlog takes longer than this (in seconds) to drain
+ADMISSION_ETA_NOTICE = 60
+# the drain rate is measured over jobs finished in this window (in seconds)
+ADMISSION_THROUGHPUT_WINDOW = 15 * 60
+# and assumed to be one job per this many seconds until enough jobs have finished
+ADMISSION_DEFAULT_JOB_SECONDS = 20
+ADMISSION_MIN_SAMPLES = 3
+# how long (in seconds) an estimate of the backlog is reused
+ADMISSION_REFRESH_SECONDS = 2
+
 ODOO_URL = "http://139.59.88.189:8069"
 ODOO_UPLOAD_ENDPOINT = f"{ODOO_URL}/revw/new_rec"
 
+# UPLOAD_REVIEWS = True
+UPLOAD_REVIEWS = False
+# failed uploads are retried with an exponential backoff (in seconds)
+UPLOAD_RETRY_BASE_DELAY = 5
+UPLOAD_RETRY_MAX_DELAY = 15 * 60
+UPLOAD_MAX_ATTEMPTS = 50
+UPLOAD_TIMEOUT = 60
+
+# Path to store the durable state of the service
+STATE_DIR = Path("./state/")
+if not STATE_DIR.exists():
+    STATE_DIR.mkdir()
+
+# every review job and its progress, to resume the interrupted ones after a restart
+JOB_JOURNAL_PATH = STATE_DIR / "jobs.sqlite3"
+# how long (in seconds) finished jobs are kept in the journal
+JOB_JOURNAL_RETENTION = 7 * 24 * 60 * 60
+
+# reviews waiting to be uploaded
+UPLOAD_OUTBOX_PATH = STATE_DIR / "upload-outbox.sqlite3"
+
+# every process writes its metrics here, and the main process serves them
+METRICS_DIR = STATE_DIR / "metrics"
+if not METRICS_DIR.exists():
+    METRICS_DIR.mkdir()
+# the Prometheus endpoint, only reachable locally
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_PORT = 9464
+
+# Path to store persistent caches
+CACHE_DIR = Path("./cache/")
+if not CACHE_DIR.exists():
+    CACHE_DIR.mkdir()
+
+# the caches expire and evict their entries once every this many writes, rather than on every one
+DISK_CACHE_MAINTENANCE_WRITES = 100
+
+# transcriptions are cached by the hash of the audio content
+TRANSCRIPTION_CACHE_PATH = CACHE_DIR / "transcriptions.sqlite3"
+TRANSCRIPTION_CACHE_MAX_ENTRIES = 10_000
+
+# LLM responses are cached by the model name and the exact prompt
+PROMPT_CACHE_PATH = CACHE_DIR / "prompts.sqlite3"
+PROMPT_CACHE_MEMORY_ENTRIES = 1_024
+PROMPT_CACHE_MAX_ENTRIES = 50_000
+# how long (in seconds) a cached response stays valid
+PROMPT_CACHE_TTL = 30 * 24 * 60 * 60
+
+# finished recordings are packed into daily archives in the background,
+# keeping only the .ogg file and the transcriptions of every one of them
+# STORAGE_COMPACTION = False
+STORAGE_COMPACTION = True
+# the recordings under this folder are compacted
+STORAGE_ROOT = Path("./home/")
+STORAGE_ARCHIVE_DIR = Path("./archive/")
+if not STORAGE_ARCHIVE_DIR.exists():
+    STORAGE_ARCHIVE_DIR.mkdir()
+# what every archive contains, to find a recording without opening the archives
+STORAGE_ARCHIVE_INDEX_PATH = STATE_DIR / "archive-index.sqlite3"
+# recordings are compacted once they are this old (in seconds)
+STORAGE_COMPACTION_MIN_AGE = 24 * 60 * 60
+# archives are deleted once they are this old (in seconds), None to keep them forever
+STORAGE_ARCHIVE_RETENTION: int | None = 365 * 24 * 60 * 60
+# how often (in seconds) the compaction runs
+STORAGE_COMPACTION_INTERVAL = 10 * 60
+# the compaction only runs while at most this many review jobs are unfinished,
+# and reads and writes at most STORAGE_COMPACTION_BYTES_PER_SECOND
+STORAGE_COMPACTION_MAX_BACKLOG = 0
+STORAGE_COMPACTION_BYTES_PER_SECOND = 4 * 1024 * 1024
+
 # Path to store audio files
 TELEGRAM_AUDIO_DIR = Path("./home/telegram-recordings/")
 if not TELEGRAM_AUDIO_DIR.exists():
     TELEGRAM_AUDIO_DIR.mkdir()
+
+# updates from different chats handled at the same time
+TELEGRAM_CONCURRENT_UPDATES = 16
+# voice notes are downloaded into memory and handed to the reviewer directly,
+# and written to TELEGRAM_AUDIO_DIR in the background. Without the files,
+# reviews interrupted by a restart can not be resumed
+TELEGRAM_ARCHIVE_RECORDINGS = True
+
+# outbound messages of the bot, within the limits of Telegram
+TELEGRAM_MESSAGES_PER_SECOND = 25
+# seconds between the messages to the same chat, the ones queued meanwhile are merged
+TELEGRAM_CHAT_MESSAGE_INTERVAL = 1.0
+# failed messages are retried with an exponential backoff (in seconds)
+TELEGRAM_SEND_MAX_ATTEMPTS = 5
+TELEGRAM_SEND_RETRY_DELAY = 2